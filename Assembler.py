@@ -0,0 +1,168 @@
+"""
+Assembler for Nand to Tetris project7, HUJI
+
+Assembles Hack assembly code into 16 bit machine words in memory. Code is
+fed in chunks as it is written, references to symbols that are not known yet
+are backpatched once all the code was fed, so a single pass suffices.
+
+"""
+
+from array import array
+
+ROM_SIZE = 32768
+FIRST_VARIABLE = 16
+ADDRESS_MASK = 0x7FFF
+
+PREDEFINED_SYMBOLS = {'SP': 0, 'LCL': 1, 'ARG': 2, 'THIS': 3, 'THAT': 4,
+                      'SCREEN': 16384, 'KBD': 24576}
+PREDEFINED_SYMBOLS.update(('R%d' % i, i) for i in range(16))
+
+# The a-bit and c-bits of every computation
+COMP = {'0': 0b0101010, '1': 0b0111111, '-1': 0b0111010,
+        'D': 0b0001100, 'A': 0b0110000, '!D': 0b0001101,
+        '!A': 0b0110001, '-D': 0b0001111, '-A': 0b0110011,
+        'D+1': 0b0011111, 'A+1': 0b0110111, 'D-1': 0b0001110,
+        'A-1': 0b0110010, 'D+A': 0b0000010, 'D-A': 0b0010011,
+        'A-D': 0b0000111, 'D&A': 0b0000000, 'D|A': 0b0010101,
+        'M': 0b1110000, '!M': 0b1110001, '-M': 0b1110011,
+        'M+1': 0b1110111, 'M-1': 0b1110010, 'D+M': 0b1000010,
+        'D-M': 0b1010011, 'M-D': 0b1000111, 'D&M': 0b1000000,
+        'D|M': 0b1010101}
+
+# Commutative spellings accepted for the computations above
+COMP_ALIASES = {'A+D': 'D+A', 'M+D': 'D+M', 'A&D': 'D&A', 'M&D': 'D&M',
+                'A|D': 'D|A', 'M|D': 'D|M', '1+D': 'D+1', '1+A': 'A+1',
+                '1+M': 'M+1'}
+COMP.update((alias, COMP[comp]) for alias, comp in COMP_ALIASES.items())
+
+DEST = {'': 0, 'M': 1, 'D': 2, 'MD': 3, 'A': 4, 'AM': 5, 'AD': 6, 'AMD': 7}
+DEST.update({'DM': 3, 'MA': 5, 'DA': 6, 'ADM': 7, 'MAD': 7, 'MDA': 7,
+             'DAM': 7, 'DMA': 7})
+
+JUMP = {'': 0, 'JGT': 1, 'JEQ': 2, 'JGE': 3, 'JLT': 4, 'JNE': 5, 'JLE': 6,
+        'JMP': 7}
+
+C_INSTRUCTION = 0b111 << 13
+
+
+class AssemblyError(Exception):
+    """
+    Raised on assembly code that can't be assembled.
+
+    """
+
+
+def clean(line):
+    """
+    Strips comments and white space from a line of assembly code.
+    :return: string, empty if there is no instruction on the line
+    """
+    comment_index = line.find('//')
+    if comment_index >= 0:
+        line = line[:comment_index]
+    return ''.join(line.split())
+
+
+def encode_c(instruction):
+    """
+    Encodes a clean C-instruction into its machine word.
+    :return: int
+    """
+    dest, _, rest = instruction.rpartition('=')
+    comp, _, jump = rest.partition(';')
+    try:
+        return (C_INSTRUCTION | COMP[comp] << 6 | DEST[dest] << 3 |
+                JUMP[jump])
+    except KeyError:
+        raise AssemblyError("Invalid instruction: %s" % instruction)
+
+
+class Assembler:
+    """
+    Incremental Hack assembler. Labels are bound to the current address as
+    they are fed; A-instructions referring to symbols that are not bound yet
+    get a placeholder word, patched in finish(). Symbols still unbound then
+    are variables, allocated from address 16 in order of first use, exactly
+    as a two pass assembler would.
+
+    """
+
+    def __init__(self):
+        self.words = array('H')
+        self.symbols = dict(PREDEFINED_SYMBOLS)
+        self.fixups = []
+        # Memo of the words of A/C-instruction lines that are fully resolved
+        self.encoded = {}
+
+    def feed(self, asm):
+        """
+        Assembles a chunk of assembly code.
+        :param asm: string of complete lines
+        """
+        words = self.words
+        symbols = self.symbols
+        encoded = self.encoded
+        for line in asm.split('\n'):
+            word = encoded.get(line)
+            if word is not None:
+                words.append(word)
+                continue
+
+            instruction = clean(line)
+            if not instruction:
+                continue
+            if instruction[0] == '(':
+                symbols[instruction[1:-1]] = len(words)
+            elif instruction[0] == '@':
+                value = instruction[1:]
+                if value.isdigit():
+                    word = encoded[line] = int(value) & ADDRESS_MASK
+                elif value in symbols:
+                    word = encoded[line] = symbols[value]
+                else:
+                    self.fixups.append((len(words), value))
+                    word = 0
+                words.append(word)
+            else:
+                word = encoded[line] = encode_c(instruction)
+                words.append(word)
+
+    def finish(self):
+        """
+        Resolves the pending symbol references, allocating variables.
+        :return: array of the machine words of the program
+        """
+        if len(self.words) > ROM_SIZE:
+            raise AssemblyError("Program of %d instructions does not fit in "
+                                "the %d words ROM" % (len(self.words),
+                                                      ROM_SIZE))
+        symbols = self.symbols
+        next_variable = FIRST_VARIABLE
+        for address, symbol in self.fixups:
+            value = symbols.get(symbol)
+            if value is None:
+                value = symbols[symbol] = next_variable
+                next_variable += 1
+            self.words[address] = value
+        self.fixups.clear()
+        return self.words
+
+
+def assemble(lines):
+    """
+    Assembles Hack assembly code.
+    :param lines: iterable of assembly lines
+    :return: (array of instruction words, symbol table)
+    """
+    assembler = Assembler()
+    for line in lines:
+        assembler.feed(line)
+    return assembler.finish(), assembler.symbols
+
+
+def to_hack(words):
+    """
+    :param words: machine words
+    :return: the .hack text of the words, a binary string per line
+    """
+    return ''.join(format(word, '016b') + '\n' for word in words)
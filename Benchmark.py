@@ -0,0 +1,283 @@
+"""
+Benchmark for Nand to Tetris project7, HUJI
+
+Generates synthetic .vm programs and measures the translator's throughput on
+them: lines per second, time spent parsing, emitting and writing, and peak
+memory. Results are compared against a stored baseline to catch regressions.
+
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from Parser import Parser
+from CodeWriter import CodeWriter
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'benchmark_baseline.json')
+
+# A run slower than the baseline by more than this fraction is a regression
+TOLERANCE = 0.2
+
+NUM_LOCALS = 4
+NUM_ARGS = 2
+THIS_BASE = 3000
+THAT_BASE = 4000
+
+# Relative weights of the statement kinds of every command mix
+MIXES = {'arithmetic': {'arithmetic': 8, 'pushpop': 1, 'call': 0, 'loop': 1},
+         'pushpop': {'arithmetic': 1, 'pushpop': 8, 'call': 0, 'loop': 1},
+         'call': {'arithmetic': 2, 'pushpop': 2, 'call': 6, 'loop': 0},
+         'mixed': {'arithmetic': 3, 'pushpop': 3, 'call': 2, 'loop': 1}}
+
+# name: (mix, files, commands per function)
+SCENARIOS = {'arithmetic': ('arithmetic', 1, 400),
+             'pushpop': ('pushpop', 1, 400),
+             'call': ('call', 1, 400),
+             'functions': ('mixed', 12, 40),
+             'mixed': ('mixed', 4, 200)}
+
+BINARY_OPS = ('add', 'sub', 'and', 'or', 'eq', 'gt', 'lt')
+UNARY_OPS = ('neg', 'not')
+PUSH_SEGMENTS = ('constant', 'local', 'argument', 'static', 'temp', 'this',
+                 'that')
+POP_SEGMENTS = ('local', 'static', 'temp', 'this', 'that')
+SEGMENT_SIZES = {'constant': 1000, 'local': NUM_LOCALS, 'argument': NUM_ARGS,
+                 'static': 8, 'temp': 8, 'this': 8, 'that': 8}
+
+
+class ProgramGenerator:
+    """
+    Generates a well formed program: the stack is balanced after every
+    statement, this/that point into the heap, and every run terminates since
+    functions only call leaf functions, which make no calls themselves.
+
+    """
+
+    def __init__(self, mix='mixed', seed=0):
+        self.random = random.Random(seed)
+        weights = MIXES[mix]
+        self.kinds = [kind for kind in weights if weights[kind]]
+        self.weights = [weights[kind] for kind in self.kinds]
+        self.leaves = []
+        self.num_labels = 0
+
+    def operand(self, segments=PUSH_SEGMENTS):
+        segment = self.random.choice(segments)
+        return segment, self.random.randrange(SEGMENT_SIZES[segment])
+
+    def arithmetic(self):
+        lines = ['push %s %d' % self.operand(), 'push %s %d' % self.operand(),
+                 self.random.choice(BINARY_OPS)]
+        if self.random.random() < 0.3:
+            lines.append(self.random.choice(UNARY_OPS))
+        lines.append('pop %s %d' % self.operand(POP_SEGMENTS))
+        return lines
+
+    def pushpop(self):
+        return ['push %s %d' % self.operand(),
+                'pop %s %d' % self.operand(POP_SEGMENTS)]
+
+    def call(self):
+        if not self.leaves:
+            return self.pushpop()
+        return ['push %s %d' % self.operand(), 'push %s %d' % self.operand(),
+                'call %s %d' % (self.random.choice(self.leaves), NUM_ARGS),
+                'pop temp 0']
+
+    def loop(self):
+        label = 'LOOP_%d' % self.num_labels
+        self.num_labels += 1
+        counter = self.random.randrange(NUM_LOCALS)
+        lines = ['push constant %d' % self.random.randint(1, 5),
+                 'pop local %d' % counter,
+                 'label ' + label]
+        for _ in range(self.random.randint(1, 3)):
+            body = self.arithmetic()
+            if body[-1] == 'pop local %d' % counter:  # keep the counter
+                body[-1] = 'pop temp 1'
+            lines += body
+        lines += ['push local %d' % counter, 'push constant 1', 'sub',
+                  'pop local %d' % counter, 'push local %d' % counter,
+                  'if-goto ' + label]
+        return lines
+
+    def function(self, name, commands, leaf):
+        """
+        :return: the vm lines of a function of about the given size
+        """
+        lines = ['function %s %d' % (name, NUM_LOCALS),
+                 'push constant %d' % THIS_BASE, 'pop pointer 0',
+                 'push constant %d' % THAT_BASE, 'pop pointer 1']
+        while len(lines) < commands:
+            kind = self.random.choices(self.kinds, self.weights)[0]
+            if leaf and kind == 'call':
+                kind = 'pushpop'
+            lines += getattr(self, kind)()
+        lines += ['push local 0', 'return']
+        return lines
+
+    def generate(self, directory, commands=10000, files=4,
+                 function_size=200):
+        """
+        Writes a program directory of about the given number of commands,
+        including a Sys.vm whose Sys.init calls every function once.
+        :return: list of the written vm file paths
+        """
+        os.makedirs(directory, exist_ok=True)
+        num_functions = max(2, commands // function_size)
+        per_file = -(-num_functions // files)
+        names = ['Gen%d.f%d' % (i // per_file, i)
+                 for i in range(num_functions)]
+        # A quarter of the functions are leaves, the rest may call them
+        self.leaves = names[::4]
+
+        files_lines = {}
+        for name in names:
+            class_name = name.split('.')[0]
+            files_lines.setdefault(class_name, []).extend(
+                self.function(name, function_size, name in self.leaves))
+
+        init = ['function Sys.init 0']
+        for name in names:
+            init += ['push constant 1', 'push constant 2',
+                     'call %s %d' % (name, NUM_ARGS), 'pop temp 0']
+        init += ['label WHILE', 'goto WHILE']
+        files_lines['Sys'] = init
+
+        paths = []
+        for class_name, lines in files_lines.items():
+            path = os.path.join(directory, class_name + '.vm')
+            with open(path, 'w') as fp:
+                fp.write('\n'.join(lines) + '\n')
+            paths.append(path)
+        return paths
+
+
+def measure(paths):
+    """
+    Translates the given files, timing every phase separately.
+    :return: dict of lines, parse, emit and write times in seconds
+    """
+    start = time.perf_counter()
+    programs = [Parser(path).program for path in paths]
+    parsed = time.perf_counter()
+
+    writer = CodeWriter(io.StringIO(), len(paths) > 1)
+    for path, program in zip(paths, programs):
+        writer.setFileName(os.path.splitext(os.path.basename(path))[0])
+        writer.writeProgram(program)
+    writer.flush()
+    emitted = time.perf_counter()
+
+    with tempfile.TemporaryFile('w') as fp:
+        fp.write(writer.asm_file.getvalue())
+    written = time.perf_counter()
+
+    return {'lines': sum(len(program) for program in programs),
+            'parse': parsed - start,
+            'emit': emitted - parsed,
+            'write': written - emitted}
+
+
+def peak_memory(paths):
+    """
+    :return: peak memory in bytes allocated while translating the files
+    """
+    tracemalloc.start()
+    try:
+        measure(paths)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_scenario(name, commands, repeat, seed=0):
+    """
+    Generates and benchmarks a single scenario, keeping the fastest run.
+    :return: dict of results
+    """
+    mix, files, function_size = SCENARIOS[name]
+    with tempfile.TemporaryDirectory() as directory:
+        paths = ProgramGenerator(mix, seed).generate(
+            directory, commands, files, function_size)
+        best = min((measure(paths) for _ in range(repeat)),
+                   key=lambda result: result['parse'] + result['emit'] +
+                   result['write'])
+        best['peak_memory'] = peak_memory(paths)
+    total = best['parse'] + best['emit'] + best['write']
+    best['lines_per_sec'] = best['lines'] / total
+    return best
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    :return: list of the names of the scenarios slower than the baseline
+    """
+    return [name for name, result in results.items()
+            if name in baseline and result['lines_per_sec'] <
+            baseline[name]['lines_per_sec'] * (1 - tolerance)]
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(
+        description="Benchmarks the translator on synthetic vm programs.")
+    arg_parser.add_argument("--scenario", action="append",
+                            choices=sorted(SCENARIOS),
+                            help="scenario to run, all if not given")
+    arg_parser.add_argument("--commands", type=int, default=50000,
+                            help="vm commands per program")
+    arg_parser.add_argument("--repeat", type=int, default=3)
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--baseline", default=BASELINE_FILE)
+    arg_parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    arg_parser.add_argument("--save-baseline", action="store_true",
+                            help="store the results as the new baseline")
+    arg_parser.add_argument("--generate", metavar="DIR",
+                            help="only write a program of the first "
+                                 "scenario to DIR")
+    args = arg_parser.parse_args(argv)
+    names = args.scenario or sorted(SCENARIOS)
+
+    if args.generate:
+        mix, files, function_size = SCENARIOS[names[0]]
+        ProgramGenerator(mix, args.seed).generate(
+            args.generate, args.commands, files, function_size)
+        return 0
+
+    results = {}
+    print("%-12s %10s %12s %8s %8s %8s %10s" % (
+        "scenario", "lines", "lines/sec", "parse", "emit", "write",
+        "peak MB"))
+    for name in names:
+        result = results[name] = run_scenario(name, args.commands,
+                                              args.repeat, args.seed)
+        print("%-12s %10d %12.0f %8.3f %8.3f %8.3f %10.1f" % (
+            name, result['lines'], result['lines_per_sec'], result['parse'],
+            result['emit'], result['write'], result['peak_memory'] / 2 ** 20))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+        print("Baseline saved to %s" % args.baseline)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline found at %s" % args.baseline)
+        return 0
+    with open(args.baseline) as fp:
+        regressions = compare(results, json.load(fp), args.tolerance)
+    for name in regressions:
+        print("Regression: %s is more than %d%% slower than the baseline"
+              % (name, args.tolerance * 100))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+"""
+Translation cache for Nand to Tetris project7, HUJI
+
+Keeps the relocatable translation of every vm file on disk, keyed by the
+file's content, so that unchanged files of a directory are not translated
+again.
+
+"""
+
+import hashlib
+import os
+import Parser
+import CodeWriter
+import Peephole
+import Optimizer
+
+# Bump when the stored format changes
+CACHE_FORMAT = 2
+
+FILE_EXTENSION_CACHE = '.frag'
+
+# Modules whose code the cached translations depend on
+TRANSLATOR_MODULES = (Parser, CodeWriter, Peephole, Optimizer)
+
+
+def translator_version(optimizations=()):
+    """
+    Fingerprints the translator itself, so that any change to the parser,
+    the code writer or the passes it runs invalidates all cached
+    translations.
+    :param optimizations: names of the code generation strategies in use,
+    translations made with others are not reused.
+    :return: hex digest string
+    """
+    digest = hashlib.sha256(str(CACHE_FORMAT).encode())
+    digest.update(','.join(sorted(optimizations)).encode())
+    for module in TRANSLATOR_MODULES:
+        with open(module.__file__, 'rb') as fp:
+            digest.update(fp.read())
+    return digest.hexdigest()
+
+
+class TranslationCache:
+    """
+    A directory of cached translations. Each entry holds the assembly code of
+    a single vm file, translated with its LTR_ and returnAddress_ labels
+    numbered from 0, along with the number of labels of each kind it used
+    and the names of the shared routines it calls.
+
+    """
+
+    def __init__(self, directory, optimizations=()):
+        """
+        :param directory: where the entries are kept, created if missing
+        :param optimizations: names of the code generation strategies the
+        cached translations are made with
+        """
+        self.directory = directory
+        self.version = translator_version(optimizations)
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, path):
+        """
+        Returns the cache key of a vm file. The file name is part of the key
+        since static variables are named after it.
+        :param path: path of the vm file
+        :return: hex digest string
+        """
+        digest = hashlib.sha256(self.version.encode())
+        digest.update(os.path.basename(path).encode() + b'\0')
+        with open(path, 'rb') as fp:
+            for block in iter(lambda: fp.read(1 << 16), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key + FILE_EXTENSION_CACHE)
+
+    def load(self, key):
+        """
+        :param key: cache key of a vm file
+        :return: (asm, num_LTR, num_RA, routines) fragment, or None if not
+        cached
+        """
+        try:
+            with open(self.entry_path(key)) as fp:
+                num_LTR, num_RA, *routines = fp.readline().split()
+                return fp.read(), int(num_LTR), int(num_RA), tuple(routines)
+        except (OSError, ValueError):
+            return None
+
+    def store(self, key, fragment):
+        """
+        Stores the fragment of a vm file. The entry is written to a temporary
+        file first, so a concurrent reader never sees half of it.
+        :param key: cache key of the vm file
+        :param fragment: (asm, num_LTR, num_RA, routines)
+        """
+        asm, num_LTR, num_RA, routines = fragment
+        entry_path = self.entry_path(key)
+        temp_path = "%s.%d.tmp" % (entry_path, os.getpid())
+        with open(temp_path, 'w') as fp:
+            fp.write(" ".join(["%d %d" % (num_LTR, num_RA)] +
+                              list(routines)) + "\n")
+            fp.write(asm)
+        os.replace(temp_path, entry_path)
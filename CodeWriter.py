@@ -1,8 +1,22 @@
+import re
+from functools import lru_cache
 from Parser import *
+from Assembler import Assembler, to_hack
+from Peephole import Peephole
+from Optimizer import fold_constants, simplify_control_flow
 
 END_LINE = '\n'
 TEMP_MEM = 5
 
+# Buffered asm is written to the output file in blocks of about this size
+FLUSH_SIZE = 1 << 16
+
+# Number of pre-rendered push/pop fragments kept
+PUSH_POP_CACHE_SIZE = 1024
+
+# Matches the uses and declarations of the writer's numbered labels
+NUMBERED_LABEL = re.compile(r'^([@(])(LTR_|returnAddress_)(\d+)', re.MULTILINE)
+
 MEMORY = {'local': 'LCL',
           'argument': 'ARG',
           'this': 'THIS',
@@ -55,6 +69,494 @@ JUMP_C = {'eq': 'D;JNE',
           'gt': 'D;JLE',
           'lt': 'D;JGE'}
 
+# Names of the optional code generation strategies
+SHARED_COMPARE = 'shared-compare'
+TRAMPOLINES = 'trampolines'
+# All the peephole rules, or a single one as 'peephole:RULE'
+PEEPHOLE = 'peephole'
+CONSTANT_FOLDING = 'constant-folding'
+# Whole program optimizations, for directories translated with writeInit
+DEAD_FUNCTIONS = 'dead-functions'
+# Inlines leaf functions of up to Optimizer.INLINE_SIZE commands, or of up
+# to N commands as 'inline:N'
+INLINE = 'inline'
+WHOLE_PROGRAM = (DEAD_FUNCTIONS, INLINE)
+# Keeps the top of the stack in D between commands
+TOS_CACHE = 'tos-cache'
+# Writes common short command sequences with specialized code
+SUPERINSTRUCTIONS = 'superinstructions'
+# Jumps on comparisons followed by if-goto without materializing a boolean
+COMPARE_BRANCH = 'compare-branch'
+# Reuses the frame of the caller for a call followed by return
+TAIL_CALLS = 'tail-calls'
+# Writes calls of Math.multiply and Math.divide as inline code
+INTRINSICS = 'intrinsics'
+# Removes unreachable code and needless jumps of every function
+CONTROL_FLOW = 'control-flow'
+# Picks the cheapest instruction sequence of every push and pop
+ADDRESSING = 'addressing'
+# Reuses the address left in A and the value left in D by the previous push
+# or pop
+BASE_REUSE = 'base-reuse'
+# Optimizations written by CodeWriter.fuse
+FUSED = (SUPERINSTRUCTIONS, COMPARE_BRANCH, TAIL_CALLS, INTRINSICS)
+
+# Optimizations enabled by every --optimize-for goal
+GOALS = {'speed': (PEEPHOLE, CONSTANT_FOLDING, DEAD_FUNCTIONS, INLINE,
+                   TOS_CACHE, SUPERINSTRUCTIONS, COMPARE_BRANCH,
+                   TAIL_CALLS, INTRINSICS, CONTROL_FLOW, ADDRESSING,
+                   BASE_REUSE),
+         'size': (SHARED_COMPARE, TRAMPOLINES, PEEPHOLE, CONSTANT_FOLDING,
+                  DEAD_FUNCTIONS, TOS_CACHE, SUPERINSTRUCTIONS,
+                  COMPARE_BRANCH, INTRINSICS, CONTROL_FLOW, ADDRESSING,
+                  BASE_REUSE)}
+
+# Comparisons, the LTR_ label number is patched in twice with %
+COMPARISON_C = {command: ('@LTR_%d' + END_LINE +
+                          COMEBACK_LINE +
+                          D_ARG1_M_ARG2 +
+                          'D=M-D' + END_LINE +
+                          '@FALSE' + END_LINE +
+                          jump + END_LINE +
+                          '@SP' + END_LINE +
+                          'A=M-1' + END_LINE +
+                          'M=1' + END_LINE +
+                          'M=-M' + END_LINE +
+                          '(LTR_%d)' + END_LINE)
+                for command, jump in JUMP_C.items()}
+
+# Comparisons calling a shared subroutine, which returns to LTR_%d
+SHARED_COMPARISON_C = {command: ('@LTR_%d' + END_LINE +
+                                 'D=A' + END_LINE +
+                                 '@$$' + command.upper() + END_LINE +
+                                 '0;JMP' + END_LINE +
+                                 '(LTR_%d)' + END_LINE)
+                       for command in JUMP_C}
+
+# Shared comparison subroutines: get the return address in D, replace the
+# two top values of the stack with the comparison's result
+TRUE_JUMP_C = {'eq': 'D;JEQ',
+               'gt': 'D;JGT',
+               'lt': 'D;JLT'}
+COMPARISON_ROUTINES = {'$$' + command.upper(): (
+    '($$' + command.upper() + ')' + END_LINE +
+    '@R13' + END_LINE +
+    'M=D' + END_LINE +
+    '@SP' + END_LINE +
+    'AM=M-1' + END_LINE +
+    'D=M' + END_LINE +
+    'A=A-1' + END_LINE +
+    'D=M-D' + END_LINE +
+    'M=-1' + END_LINE +
+    '@$$' + command.upper() + '_END' + END_LINE +
+    jump + END_LINE +
+    '@SP' + END_LINE +
+    'A=M-1' + END_LINE +
+    'M=0' + END_LINE +
+    '($$' + command.upper() + '_END)' + END_LINE +
+    '@R13' + END_LINE +
+    'A=M' + END_LINE +
+    '0;JMP' + END_LINE)
+    for command, jump in TRUE_JUMP_C.items()}
+
+# With the top of the stack y cached in D: comparisons calling a shared
+# subroutine with y in R13, which returns to LTR_%d with the result in D
+CACHED_SHARED_COMPARISON_C = {command: ('@R13' + END_LINE +
+                                        'M=D' + END_LINE +
+                                        '@LTR_%d' + END_LINE +
+                                        'D=A' + END_LINE +
+                                        '@$$' + command.upper() + '_D' +
+                                        END_LINE +
+                                        '0;JMP' + END_LINE +
+                                        '(LTR_%d)' + END_LINE)
+                              for command in JUMP_C}
+
+# Shared comparison subroutines of the cached top of the stack: get the
+# return address in D and y in R13, pop x and leave the comparison's result
+# in D
+CACHED_COMPARISON_ROUTINES = {'$$' + command.upper() + '_D': (
+    '($$' + command.upper() + '_D)' + END_LINE +
+    '@R14' + END_LINE +
+    'M=D' + END_LINE +
+    '@SP' + END_LINE +
+    'AM=M-1' + END_LINE +
+    'D=M' + END_LINE +
+    '@R13' + END_LINE +
+    'D=D-M' + END_LINE +
+    '@$$' + command.upper() + '_D_TRUE' + END_LINE +
+    jump + END_LINE +
+    'D=0' + END_LINE +
+    '@R14' + END_LINE +
+    'A=M' + END_LINE +
+    '0;JMP' + END_LINE +
+    '($$' + command.upper() + '_D_TRUE)' + END_LINE +
+    'D=-1' + END_LINE +
+    '@R14' + END_LINE +
+    'A=M' + END_LINE +
+    '0;JMP' + END_LINE)
+    for command, jump in TRUE_JUMP_C.items()}
+
+# Pushes D and then the given pointer on the stack, SP ends on the pointer
+PUSH_POINTER_C = ('@%s' + END_LINE +
+                  'D=M' + END_LINE +
+                  '@SP' + END_LINE +
+                  'AM=M+1' + END_LINE +
+                  'M=D' + END_LINE)
+
+# Shared call routine: gets the return address in D, the address of the
+# called function in R13 and its number of arguments in R14, and builds the
+# same frame as writeCall
+CALL_ROUTINE = ('($$CALL)' + END_LINE +
+                '@SP' + END_LINE +
+                'A=M' + END_LINE +
+                'M=D' + END_LINE +
+                ''.join(PUSH_POINTER_C % pointer
+                        for pointer in ('LCL', 'ARG', 'THIS', 'THAT')) +
+                '@SP' + END_LINE +
+                'MD=M+1' + END_LINE +
+                '@LCL' + END_LINE +
+                'M=D' + END_LINE +
+                '@R14' + END_LINE +
+                'D=D-M' + END_LINE +
+                '@5' + END_LINE +
+                'D=D-A' + END_LINE +
+                '@ARG' + END_LINE +
+                'M=D' + END_LINE +
+                '@R13' + END_LINE +
+                'A=M' + END_LINE +
+                '0;JMP' + END_LINE)
+
+# Shared return routine, does what writeReturn does, keeping the frame
+# address in R13 and the return address in R14
+RETURN_ROUTINE = ('($$RETURN)' + END_LINE +
+                  '@LCL' + END_LINE +
+                  'D=M' + END_LINE +
+                  '@R13' + END_LINE +
+                  'M=D' + END_LINE +
+                  '@5' + END_LINE +
+                  'A=D-A' + END_LINE +
+                  'D=M' + END_LINE +
+                  '@R14' + END_LINE +
+                  'M=D' + END_LINE +
+                  '@SP' + END_LINE +
+                  'AM=M-1' + END_LINE +
+                  'D=M' + END_LINE +
+                  '@ARG' + END_LINE +
+                  'A=M' + END_LINE +
+                  'M=D' + END_LINE +
+                  '@ARG' + END_LINE +
+                  'D=M+1' + END_LINE +
+                  '@SP' + END_LINE +
+                  'M=D' + END_LINE +
+                  ''.join('@R13' + END_LINE +
+                          'AM=M-1' + END_LINE +
+                          'D=M' + END_LINE +
+                          '@' + pointer + END_LINE +
+                          'M=D' + END_LINE
+                          for pointer in ('THAT', 'THIS', 'ARG', 'LCL')) +
+                  '@R14' + END_LINE +
+                  'A=M' + END_LINE +
+                  '0;JMP' + END_LINE)
+
+# Shared multiplication routine: gets the return address in D, replaces
+# the two top values x, y of the stack with x * y. Adds x * 2^i to the
+# product in R15 for every bit i of y in R14, x being doubled in R13. The
+# return address waits above y.
+MULTIPLY_ROUTINE = ('($$MULTIPLY)' + END_LINE +
+                    '@SP' + END_LINE +
+                    'AM=M-1' + END_LINE +
+                    'A=A+1' + END_LINE +
+                    'M=D' + END_LINE +
+                    'A=A-1' + END_LINE +
+                    'D=M' + END_LINE +
+                    '@R14' + END_LINE +
+                    'M=D' + END_LINE +
+                    '@SP' + END_LINE +
+                    'A=M-1' + END_LINE +
+                    'D=M' + END_LINE +
+                    '@R13' + END_LINE +
+                    'M=D' + END_LINE +
+                    '@R15' + END_LINE +
+                    'M=0' + END_LINE +
+                    ''.join(('@' + str(1 << bit) + END_LINE +
+                             'D=A' + END_LINE +
+                             '@R14' + END_LINE +
+                             'D=D&M' + END_LINE +
+                             '@$$MULTIPLY_%d' % bit + END_LINE +
+                             'D;JEQ' + END_LINE
+                             if bit < 15 else
+                             '@R14' + END_LINE +
+                             'D=M' + END_LINE +
+                             '@$$MULTIPLY_%d' % bit + END_LINE +
+                             'D;JGE' + END_LINE) +
+                            '@R13' + END_LINE +
+                            'D=M' + END_LINE +
+                            '@R15' + END_LINE +
+                            'M=D+M' + END_LINE +
+                            '($$MULTIPLY_%d)' % bit + END_LINE +
+                            ('@R13' + END_LINE +
+                             'D=M' + END_LINE +
+                             'M=D+M' + END_LINE if bit < 15 else '')
+                            for bit in range(16)) +
+                    '@R15' + END_LINE +
+                    'D=M' + END_LINE +
+                    '@SP' + END_LINE +
+                    'A=M-1' + END_LINE +
+                    'M=D' + END_LINE +
+                    'A=A+1' + END_LINE +
+                    'A=A+1' + END_LINE +
+                    'A=M' + END_LINE +
+                    '0;JMP' + END_LINE)
+
+# Shared division routine: gets the return address in D, replaces the two
+# top values x, y of the stack with x / y rounded toward 0, as Math.divide.
+# Divides |x| by |y| bit by bit, shifting |x| out of R13 into the remainder
+# in R15 and the bits of the quotient into R13, then negates the quotient
+# if only one of x and y is negative. Division by 0 is not reported. The
+# return address waits above y.
+DIVIDE_ROUTINE = ('($$DIVIDE)' + END_LINE +
+                  '@SP' + END_LINE +
+                  'AM=M-1' + END_LINE +
+                  'A=A+1' + END_LINE +
+                  'M=D' + END_LINE +
+                  'A=A-1' + END_LINE +
+                  'D=M' + END_LINE +
+                  '@R14' + END_LINE +
+                  'M=D' + END_LINE +
+                  '@$$DIVIDE_Y' + END_LINE +
+                  'D;JGE' + END_LINE +
+                  '@R14' + END_LINE +
+                  'M=-D' + END_LINE +
+                  '($$DIVIDE_Y)' + END_LINE +
+                  '@SP' + END_LINE +
+                  'A=M-1' + END_LINE +
+                  'D=M' + END_LINE +
+                  '@R13' + END_LINE +
+                  'M=D' + END_LINE +
+                  '@$$DIVIDE_X' + END_LINE +
+                  'D;JGE' + END_LINE +
+                  '@R13' + END_LINE +
+                  'M=-D' + END_LINE +
+                  '($$DIVIDE_X)' + END_LINE +
+                  '@R15' + END_LINE +
+                  'M=0' + END_LINE +
+                  ''.join('@R15' + END_LINE +
+                          'D=M' + END_LINE +
+                          'M=D+M' + END_LINE +
+                          '@R13' + END_LINE +
+                          'D=M' + END_LINE +
+                          '@$$DIVIDE_%d' % bit + END_LINE +
+                          'D;JGE' + END_LINE +
+                          '@R15' + END_LINE +
+                          'M=M+1' + END_LINE +
+                          '($$DIVIDE_%d)' % bit + END_LINE +
+                          '@R13' + END_LINE +
+                          'M=D+M' + END_LINE +
+                          '@R14' + END_LINE +
+                          'D=M' + END_LINE +
+                          '@R15' + END_LINE +
+                          'D=M-D' + END_LINE +
+                          '@$$DIVIDE_%d_END' % bit + END_LINE +
+                          'D;JLT' + END_LINE +
+                          '@R15' + END_LINE +
+                          'M=D' + END_LINE +
+                          '@R13' + END_LINE +
+                          'M=M+1' + END_LINE +
+                          '($$DIVIDE_%d_END)' % bit + END_LINE
+                          for bit in range(16)) +
+                  ''.join('@SP' + END_LINE +
+                          'A=M' + ('-1' if operand == 'X' else '') +
+                          END_LINE +
+                          'D=M' + END_LINE +
+                          '@$$DIVIDE_%s_SIGN' % operand + END_LINE +
+                          'D;JGE' + END_LINE +
+                          '@R13' + END_LINE +
+                          'M=-M' + END_LINE +
+                          '($$DIVIDE_%s_SIGN)' % operand + END_LINE
+                          for operand in ('Y', 'X')) +
+                  '@R13' + END_LINE +
+                  'D=M' + END_LINE +
+                  '@SP' + END_LINE +
+                  'A=M-1' + END_LINE +
+                  'M=D' + END_LINE +
+                  'A=A+1' + END_LINE +
+                  'A=A+1' + END_LINE +
+                  'A=M' + END_LINE +
+                  '0;JMP' + END_LINE)
+
+# Functions written as a call of a shared routine by the intrinsics
+# optimization, called with two arguments
+INTRINSIC_ROUTINES = {'Math.multiply': '$$MULTIPLY',
+                      'Math.divide': '$$DIVIDE'}
+INTRINSIC_CALLS = tuple((name, 2) for name in INTRINSIC_ROUTINES)
+
+# Calls a shared routine, which returns to LTR_%d
+ROUTINE_CALL_C = ('@LTR_%d' + END_LINE +
+                  'D=A' + END_LINE +
+                  '@%s' + END_LINE +
+                  '0;JMP' + END_LINE +
+                  '(LTR_%d)' + END_LINE)
+
+# Code shared by all the call sites using it, written once after the program
+ROUTINES = {'FALSE': FALSE_ACTION}
+ROUTINES.update(COMPARISON_ROUTINES)
+ROUTINES.update(CACHED_COMPARISON_ROUTINES)
+ROUTINES['$$CALL'] = CALL_ROUTINE
+ROUTINES['$$RETURN'] = RETURN_ROUTINE
+ROUTINES['$$MULTIPLY'] = MULTIPLY_ROUTINE
+ROUTINES['$$DIVIDE'] = DIVIDE_ROUTINE
+
+# With the top of the stack cached in D: stores D on the stack
+SPILL = ('@SP' + END_LINE +
+         'AM=M+1' + END_LINE +
+         'A=A-1' + END_LINE +
+         'M=D' + END_LINE)
+
+# With the top of the stack cached in D: pops the value below it into M
+POP_SECOND = ('@SP' + END_LINE +
+              'AM=M-1' + END_LINE)
+
+# With the top of the stack not cached: pops it into D
+POP_D = ('@SP' + END_LINE +
+         'AM=M-1' + END_LINE +
+         'D=M' + END_LINE)
+
+# With the top of the stack y cached in D and x in M
+CACHED_ARITHMETIC_C = {'add': 'D=D+M' + END_LINE,
+                       'sub': 'D=M-D' + END_LINE,
+                       'and': 'D=D&M' + END_LINE,
+                       'or': 'D=D|M' + END_LINE}
+CACHED_UNARY_C = {'neg': 'D=-D' + END_LINE,
+                  'not': 'D=!D' + END_LINE}
+
+# Comparison of x in M and y cached in D, leaving the result in D, using two
+# LTR_ labels patched in with %
+CACHED_COMPARISON_C = {command: ('D=M-D' + END_LINE +
+                                 '@LTR_%d' + END_LINE +
+                                 jump + END_LINE +
+                                 'D=0' + END_LINE +
+                                 '@LTR_%d' + END_LINE +
+                                 '0;JMP' + END_LINE +
+                                 '(LTR_%d)' + END_LINE +
+                                 'D=-1' + END_LINE +
+                                 '(LTR_%d)' + END_LINE)
+                       for command, jump in TRUE_JUMP_C.items()}
+
+# Binary operations of a superinstruction on x in D and a y constant in A
+# or a y variable in M
+FUSED_ARITHMETIC_C = {'add': ('D=D+A', 'D=D+M'),
+                      'sub': ('D=D-A', 'D=D-M'),
+                      'and': ('D=D&A', 'D=D&M'),
+                      'or': ('D=D|A', 'D=D|M')}
+
+# Longest command sequence written as a superinstruction
+FUSION_WINDOW = 5
+
+# Copies a word from the address after R13 to the address after R14,
+# advancing both
+COPY_NEXT = ('@R13' + END_LINE +
+             'AM=M+1' + END_LINE +
+             'D=M' + END_LINE +
+             '@R14' + END_LINE +
+             'AM=M+1' + END_LINE +
+             'M=D' + END_LINE)
+
+# Points R13 before the n arguments on top of the stack and R14 before the
+# caller's arguments, the number of arguments plus one patched in with %
+TAIL_ARGUMENTS = ('@SP' + END_LINE +
+                  'D=M' + END_LINE +
+                  '@%d' + END_LINE +
+                  'D=D-A' + END_LINE +
+                  '@R13' + END_LINE +
+                  'M=D' + END_LINE +
+                  '@ARG' + END_LINE +
+                  'D=M-1' + END_LINE +
+                  '@R14' + END_LINE +
+                  'M=D' + END_LINE)
+
+# Copies the caller's saved frame to the top of the stack, above the
+# arguments of a tail call
+TAIL_FRAME = ('@LCL' + END_LINE +
+              'D=M' + END_LINE +
+              '@6' + END_LINE +
+              'D=D-A' + END_LINE +
+              '@R13' + END_LINE +
+              'M=D' + END_LINE +
+              '@SP' + END_LINE +
+              'D=M' + END_LINE +
+              '@R14' + END_LINE +
+              'M=D-1' + END_LINE +
+              COPY_NEXT * 5)
+
+# Segments whose consecutive entries have consecutive addresses
+CONTIGUOUS_SEGMENTS = ('local', 'argument', 'this', 'that', 'temp',
+                       'pointer')
+
+# Constants the ALU computes without loading A
+ALU_CONSTANTS = (-1, 0, 1)
+
+# Segment entries up to this index are addressed by incrementing the base
+# pointer (A=M+1, A=A+1...) when storing D, which is cheaper than saving D
+# in R13 to compute the address
+MAX_INCREMENTED_INDEX = 8
+
+#
+PUSH_ZERO = ('@SP' + END_LINE +
+             'A=M' + END_LINE +
+             'M=0' + END_LINE +
+             '@SP' + END_LINE +
+             'M=M+1' + END_LINE)
+
+
+def relocate(asm, ltr_offset, ra_offset):
+    """
+    Shifts the numbered labels of translated assembly code.
+    :param asm: assembly code string
+    :param ltr_offset: added to the number of every LTR_ label
+    :param ra_offset: added to the number of every returnAddress_ label
+    :return: the relocated assembly code string
+    """
+    if not ltr_offset and not ra_offset:
+        return asm
+    offsets = {'LTR_': ltr_offset, 'returnAddress_': ra_offset}
+    # Splits into [text, '@' or '(', kind, number, text, ...]
+    parts = NUMBERED_LABEL.split(asm)
+    parts[3::4] = [str(int(number) + offsets[kind])
+                   for kind, number in zip(parts[2::4], parts[3::4])]
+    return ''.join(parts)
+
+
+def multiply_by(k):
+    """
+    Renders the assembly code multiplying D by a constant. D is doubled
+    through R13 for every bit of k, and added to the sum in R14 for every
+    set bit, the highest one being added to the sum in D directly.
+    :param k: the constant
+    :return: the assembly code string
+    """
+    if k == 0:
+        return 'D=0' + END_LINE
+    bits = bin(abs(k))[:1:-1]
+    top = len(bits) - 1
+    code = ''
+    address = None
+    summed = False
+    for bit in bits[:top]:
+        if bit == '1':
+            code += ('@R14' + END_LINE +
+                     ('M=D+M' if summed else 'M=D') + END_LINE)
+            address = 'R14'
+            summed = True
+        if address != 'R13':
+            code += '@R13' + END_LINE
+            address = 'R13'
+        code += 'M=D' + END_LINE + 'D=D+M' + END_LINE
+    if summed:
+        code += '@R14' + END_LINE + 'D=D+M' + END_LINE
+    if k < 0:
+        code += 'D=-D' + END_LINE
+    return code
+
 
 class CodeWriter:
     """
@@ -62,14 +564,61 @@ class CodeWriter:
      translates the command to assembler, and write it to the output file.
     """
 
-    def __init__(self, file, multifile=False):
+    def __init__(self, file, multifile=False, stats=None, assemble=False,
+                 optimizations=()):
         """
         Initialize a CodeWriter object.
-        :param file: the file the object will write the translation to.
+        :param file: the file path (or writable file object) the object will
+        write the translation to.
+        :param multifile: if True, the bootstrap code is written first.
+        :param stats: a Stats object instrumenting this writer, or None.
+        :param assemble: if True, the translation is assembled in memory and
+        written as .hack machine code instead of assembly code.
+        :param optimizations: names of the optional code generation
+        strategies to use.
         """
-        self.asm_file = open(file, 'w')
+        self.asm_file = open(file, 'w') if isinstance(file, str) else file
         self.num_LTR = 0
         self.num_RA = 0
+        self.optimizations = frozenset(optimizations)
+        # Names of the ROUTINES the code written so far uses
+        self.routines = set()
+
+        # asm waiting to be written, flushed in blocks of FLUSH_SIZE
+        self.chunks = []
+        self.buffered = 0
+        self.assembler = Assembler() if assemble else None
+        self.peephole = self.peepholeOptimizer()
+        self._push_pop_cache = lru_cache(PUSH_POP_CACHE_SIZE)(
+            self.renderPushPop)
+        # Whether the top of the stack is in D rather than in memory
+        self.cached = False
+        # (segment, index) of the entry whose address is in A and of the
+        # one whose value is in D, set by writeReusingPushPop after writing
+        # a push or pop and cleared by anything else written
+        self.registers = None
+        self._cached_push_pop_cache = lru_cache(PUSH_POP_CACHE_SIZE)(
+            self.renderCachedPushPop)
+
+        # Dispatch table from an opcode to the writer of that command, each
+        # entry accepts (opcode, first argument name, second argument)
+        self.dispatch = (
+            (lambda op, arg1, arg2:
+             self.writeArithmetic(ARITHMETIC_OPS[op]),) * len(ARITHMETIC_OPS)
+            + (lambda op, arg1, arg2:
+               self.writePushPop(Command.C_PUSH, arg1, arg2),
+               lambda op, arg1, arg2:
+               self.writePushPop(Command.C_POP, arg1, arg2),
+               lambda op, arg1, arg2: self.writeLabel(arg1),
+               lambda op, arg1, arg2: self.writeGoto(arg1),
+               lambda op, arg1, arg2: self.writeIf(arg1),
+               lambda op, arg1, arg2: self.writeFunction(arg1, arg2),
+               lambda op, arg1, arg2: self.writeReturn(),
+               lambda op, arg1, arg2: self.writeCall(arg1, arg2)))
+
+        if stats is not None:
+            stats.instrument(self)
+
         if multifile:
             self.setFileName("Sys")
             self.cur_func = "init"
@@ -81,6 +630,45 @@ class CodeWriter:
         # Some initialization of function name. this may be extra
 
 
+    def _emit(self, asm):
+        """
+        Buffers assembly code, writing it out once enough has accumulated.
+        :param asm: assembly code string
+        """
+        self.chunks.append(asm)
+        self.buffered += len(asm)
+        self.registers = None
+        if self.buffered >= FLUSH_SIZE:
+            self.flush(False)
+
+    def flush(self, final=True):
+        """
+        Writes all the buffered assembly code to the output file, or to the
+        assembler if the output is machine code.
+        :param final: if False, the peephole optimizer may keep the last few
+        lines back until the next flush.
+        """
+        asm = ''.join(self.chunks)
+        if self.peephole is not None:
+            asm = self.peephole.optimize(asm, final)
+        if self.assembler is not None:
+            self.assembler.feed(asm)
+        else:
+            self.asm_file.write(asm)
+        self.chunks.clear()
+        self.buffered = 0
+
+    def peepholeOptimizer(self):
+        """
+        :return: a Peephole applying the rules named by the optimizations,
+        or None if there are none.
+        """
+        if PEEPHOLE in self.optimizations:
+            return Peephole()
+        rules = [name[len(PEEPHOLE) + 1:] for name in self.optimizations
+                 if name.startswith(PEEPHOLE + ':')]
+        return Peephole(rules) if rules else None
+
     def setFileName(self, file):
         """
         Sets the name of the current file the object is translating from.
@@ -89,28 +677,83 @@ class CodeWriter:
         """
         self.vm_file = file
 
+    def writeProgram(self, program):
+        """
+        Writes the assembly code of all the commands of a parsed program.
+        :param program: a Program of the current file.
+        """
+        self.writeCommands(program.commands(), program.names)
+
+    def writeCommands(self, commands, names):
+        """
+        Writes the assembly code of a stream of parsed commands.
+        :param commands: iterable of (opcode, arg1, arg2) triplets.
+        :param names: the NameTable the name ids of the commands refer to.
+        """
+        if CONSTANT_FOLDING in self.optimizations:
+            commands = fold_constants(commands)
+        if CONTROL_FLOW in self.optimizations:
+            commands = simplify_control_flow(commands)
+        names = names.names
+        if self.optimizations.intersection(FUSED):
+            commands = self.fuse(commands, names)
+        dispatch = self.dispatch
+        for op, arg1, arg2 in commands:
+            dispatch[op](op, names[arg1], arg2)
+        self.spill()
+
+    def fragment(self):
+        """
+        Flushes the writer and returns what it translated so far as a
+        fragment for another writer's writeFragment.
+        :return: (asm, num_LTR, num_RA, routines)
+        """
+        self.flush()
+        return (self.asm_file.getvalue(), self.num_LTR, self.num_RA,
+                tuple(sorted(self.routines)))
+
+    def writeFragment(self, asm, num_LTR, num_RA, routines=()):
+        """
+        Writes assembly code translated by another writer, renumbering its
+        LTR_ and returnAddress_ labels to follow the ones of this writer.
+        :param asm: the assembly code of the other writer
+        :param num_LTR: the number of LTR_ labels the other writer used
+        :param num_RA: the number of returnAddress_ labels the other writer
+        used
+        :param routines: names of the shared routines the other writer used
+        """
+        self.spill()
+        self._emit(relocate(asm, self.num_LTR, self.num_RA))
+        self.num_LTR += num_LTR
+        self.num_RA += num_RA
+        self.routines.update(routines)
+
     def writeArithmetic(self, command):
         """
         Writes the assembly code that is the translation of the given arithmetic command.
         :param command: the arithmetic command that will be executed on the stack.
         """
-        if command in USING_FALSE_ACTION:
-
-            self.asm_file.write('@LTR_' + str(self.num_LTR) + END_LINE +
-                                COMEBACK_LINE +
-                                D_ARG1_M_ARG2 +
-                                'D=M-D' + END_LINE +
-                                '@FALSE' + END_LINE)
-
-            self.asm_file.write(JUMP_C[command] + END_LINE +
-                                '@SP' + END_LINE +
-                                'A=M-1' + END_LINE +
-                                'M=1' + END_LINE +
-                                'M=-M' + END_LINE +
-                                '(LTR_' + str(self.num_LTR) + ')' + END_LINE)
+        if command in USING_FALSE_ACTION and \
+                SHARED_COMPARE in self.optimizations:
+            if self.cached:
+                # y stays cached, the routine leaves the result in D
+                self._emit(CACHED_SHARED_COMPARISON_C[command] %
+                           (self.num_LTR, self.num_LTR))
+                self.routines.add('$$' + command.upper() + '_D')
+            else:
+                self._emit(SHARED_COMPARISON_C[command] %
+                           (self.num_LTR, self.num_LTR))
+                self.routines.add('$$' + command.upper())
+            self.num_LTR += 1
+        elif TOS_CACHE in self.optimizations:
+            self.writeCachedArithmetic(command)
+        elif command in USING_FALSE_ACTION:
+            self._emit(COMPARISON_C[command] %
+                       (self.num_LTR, self.num_LTR))
+            self.routines.add('FALSE')
             self.num_LTR += 1
         else:
-            self.asm_file.write(ARITHMETIC_C[command])
+            self._emit(ARITHMETIC_C[command])
 
     def writePushPop(self, command, segment, index):
         """
@@ -120,37 +763,576 @@ class CodeWriter:
         :param segment: the memory segment name.
         :param index: the index in the given segment.
         """
+        if BASE_REUSE in self.optimizations and segment in SEGMENTS:
+            self.writeReusingPushPop(command, segment, index)
+        elif TOS_CACHE in self.optimizations and segment in SEGMENTS:
+            self.writeCachedPushPop(command, segment, index)
+        elif segment == 'return_address':  # unique, not worth caching
+            self._emit(self.renderPushPop(command, segment, index,
+                                          self.vm_file))
+        else:
+            self._emit(self._push_pop_cache(command, segment, index,
+                                            self.vm_file))
+
+    def spill(self):
+        """
+        Stores the top of the stack cached in D, if it is, back on the
+        stack. Code reached by jumps expects the whole stack in memory.
+        """
+        if self.cached:
+            self._emit(SPILL)
+            self.cached = False
+
+    def writeCachedArithmetic(self, command):
+        """
+        Writes an arithmetic command operating on the top of the stack cached
+        in D, leaving its result there.
+        :param command: the arithmetic command
+        """
+        if command in CACHED_UNARY_C:
+            if not self.cached:
+                self._emit(POP_D)
+            self._emit(CACHED_UNARY_C[command])
+        else:
+            if not self.cached:
+                self._emit(POP_D)
+            self._emit(POP_SECOND)
+            if command in CACHED_COMPARISON_C:
+                self._emit(CACHED_COMPARISON_C[command] % (
+                    self.num_LTR, self.num_LTR + 1, self.num_LTR,
+                    self.num_LTR + 1))
+                self.num_LTR += 2
+            else:
+                self._emit(CACHED_ARITHMETIC_C[command])
+        self.cached = True
+
+    def writeCachedPushPop(self, command, segment, index):
+        """
+        Writes a push or pop command on the top of the stack cached in D: a
+        push spills the cached value and loads the new one into D, a pop
+        stores D.
+        :param command: its C_PUSH or C_POP type command.
+        :param segment: the memory segment name.
+        :param index: the index in the given segment.
+        """
+        if command == Command.C_PUSH:
+            self.spill()
+            self.cached = True
+        elif segment == 'constant':
+            return
+        else:
+            if not self.cached:
+                self._emit(POP_D)
+            self.cached = False
+        self._emit(self._cached_push_pop_cache(command, segment, index,
+                                               self.vm_file))
+
+    def writeReusingPushPop(self, command, segment, index):
+        """
+        Writes a push or pop command, reusing what the previous push or pop
+        of the same basic block left in the registers: a push of the entry
+        whose value is in D loads nothing, and an entry near the one whose
+        address is in A is reached by stepping A when that is cheaper.
+        Works with and without the top of the stack cached in D.
+        :param command: its C_PUSH or C_POP type command.
+        :param segment: the memory segment name.
+        :param index: the index in the given segment.
+        """
+        address, value = self.registers or (None, None)
+        entry = (segment, index)
+        cached = TOS_CACHE in self.optimizations
+        if command == Command.C_PUSH:
+            if cached:
+                if self.cached:
+                    self.spill()  # keeps D but not A
+                    address = None
+                self.cached = True
+            if value == entry:
+                code = ''
+            elif segment == 'constant' and not cached:
+                self._emit(self._push_pop_cache(command, segment, index,
+                                                self.vm_file))
+                return
+            else:
+                code = self.renderReused(command, segment, index, address)
+            if not cached:
+                code += SPILL
+                address = None
+            elif code:
+                address = entry if segment != 'constant' else None
+            self._emit(code)
+            self.registers = (address, entry)
+            return
+
+        if segment == 'constant':
+            if cached:
+                self.writeCachedPushPop(command, segment, index)
+            else:
+                self._emit(self._push_pop_cache(command, segment, index,
+                                                self.vm_file))
+            return
+        if cached and self.cached:
+            self._emit(self.renderReused(command, segment, index, address))
+        elif cached:
+            self._emit(POP_D + self._cached_push_pop_cache(
+                command, segment, index, self.vm_file))
+        else:
+            self._emit(self._push_pop_cache(command, segment, index,
+                                            self.vm_file))
+        self.cached = False
+        self.registers = (entry, entry)
+
+    def renderReused(self, command, segment, index, address):
+        """
+        Renders the assembly code loading a segment entry into D for a push,
+        or storing D into it for a pop, stepping A from the entry whose
+        address it holds if that takes fewer instructions.
+        :param address: (segment, index) of the entry whose address is in A,
+        or None
+        :return: the assembly code string
+        """
+        code = self._cached_push_pop_cache(command, segment, index,
+                                           self.vm_file)
+        if address is None or address[0] != segment or \
+                segment not in CONTIGUOUS_SEGMENTS:
+            return code
+        steps = index - address[1]
+        if abs(steps) + 1 >= code.count(END_LINE):
+            return code
+        return (('A=A+1' if steps > 0 else 'A=A-1') + END_LINE) * \
+            abs(steps) + ('D=M' if command == Command.C_PUSH else 'M=D') + \
+            END_LINE
+
+    def renderCachedPushPop(self, command, segment, index, vm_file):
+        """
+        Renders the assembly code loading a segment entry into D for a push,
+        or storing D into it for a pop.
+        :return: the assembly code string
+        """
+        if ADDRESSING in self.optimizations:
+            return self.renderCheapest(command, segment, index, True)
+        if command == Command.C_PUSH:
+            if segment == 'constant' and index < 0:
+                return ('@' + str(-index) + END_LINE +
+                        'D=-A' + END_LINE)
+            return ('@' + self.findMemory(segment, index) + END_LINE +
+                    ('D=A' if segment == 'constant' else 'D=M') + END_LINE)
+
+        address = self.renderAddress(segment, index)
+        if address is not None:
+            return address + 'M=D' + END_LINE
+        return ('@R13' + END_LINE +
+                'M=D' + END_LINE +
+                '@' + MEMORY[segment] + END_LINE +
+                'D=M' + END_LINE +
+                '@' + str(index) + END_LINE +
+                'D=D+A' + END_LINE +
+                '@R14' + END_LINE +
+                'M=D' + END_LINE +
+                '@R13' + END_LINE +
+                'D=M' + END_LINE +
+                '@R14' + END_LINE +
+                'A=M' + END_LINE +
+                'M=D' + END_LINE)
+
+    def renderAddress(self, segment, index):
+        """
+        Renders assembly code pointing A at a segment entry without using D.
+        :return: the assembly code string, or None if the entry can't be
+        addressed without D
+        """
+        if segment in MEMORY:
+            if index > MAX_INCREMENTED_INDEX:
+                return None
+            return ('@' + MEMORY[segment] + END_LINE +
+                    ('A=M' if index == 0 else 'A=M+1') + END_LINE +
+                    ('A=A+1' + END_LINE) * (index - 1))
+        if segment == 'constant':
+            return None
+        return '@' + self.findMemory(segment, index) + END_LINE
+
+    def addressingCandidates(self, command, segment, index, cached):
+        """
+        Renders the equivalent instruction sequences of a push or pop.
+        :param command: its C_PUSH or C_POP type command.
+        :param segment: the memory segment name.
+        :param index: the index in the given segment.
+        :param cached: if True, the top of the stack is cached in D: a push
+        loads the entry into D and a pop stores D into it. Otherwise the
+        value goes through the stack in memory.
+        :return: list of (strategy name, assembly code string), in order of
+        preference between sequences of the same cost
+        """
+        if segment == 'constant':
+            if command == Command.C_POP:
+                return [('none', '')]
+            loads = [('constant', '@' + str(abs(index)) + END_LINE +
+                      ('D=-A' if index < 0 else 'D=A') + END_LINE)]
+            if index in ALU_CONSTANTS:
+                loads.insert(0, ('alu-constant',
+                                 'D=' + str(index) + END_LINE))
+        elif segment in MEMORY:
+            base = MEMORY[segment]
+            increment = ('@' + base + END_LINE +
+                         ('A=M' if index == 0 else 'A=M+1') + END_LINE +
+                         ('A=A+1' + END_LINE) * (index - 1))
+            loads = [('increment', increment + 'D=M' + END_LINE),
+                     ('offset', '@' + base + END_LINE +
+                      'D=M' + END_LINE +
+                      '@' + str(index) + END_LINE +
+                      'A=D+A' + END_LINE +
+                      'D=M' + END_LINE)]
+            stores = [('increment', increment + 'M=D' + END_LINE),
+                      ('scratch', '@R13' + END_LINE +
+                       'M=D' + END_LINE +
+                       '@' + base + END_LINE +
+                       'D=M' + END_LINE +
+                       '@' + str(index) + END_LINE +
+                       'D=D+A' + END_LINE +
+                       '@R14' + END_LINE +
+                       'M=D' + END_LINE +
+                       '@R13' + END_LINE +
+                       'D=M' + END_LINE +
+                       '@R14' + END_LINE +
+                       'A=M' + END_LINE +
+                       'M=D' + END_LINE)]
+        else:
+            address = '@' + self.findMemory(segment, index) + END_LINE
+            loads = [('direct', address + 'D=M' + END_LINE)]
+            stores = [('direct', address + 'M=D' + END_LINE)]
+
+        if command == Command.C_PUSH:
+            if cached:
+                return loads
+            candidates = [(name, load + SPILL) for name, load in loads]
+            if segment == 'constant' and index in ALU_CONSTANTS:
+                candidates.insert(0, ('alu-constant-store',
+                                      '@SP' + END_LINE +
+                                      'AM=M+1' + END_LINE +
+                                      'A=A-1' + END_LINE +
+                                      'M=' + str(index) + END_LINE))
+            return candidates
+        if cached:
+            return stores
+        candidates = [(name, POP_D + store) for name, store in stores]
+        if segment in MEMORY:
+            # The address is computed before the value is popped into D
+            candidates.append(('address-first',
+                               '@' + MEMORY[segment] + END_LINE +
+                               'D=M' + END_LINE +
+                               '@' + str(index) + END_LINE +
+                               'D=D+A' + END_LINE +
+                               '@R13' + END_LINE +
+                               'M=D' + END_LINE +
+                               POP_D +
+                               '@R13' + END_LINE +
+                               'A=M' + END_LINE +
+                               'M=D' + END_LINE))
+        return candidates
+
+    def addressingCosts(self, command, segment, index, cached=False):
+        """
+        The cost model of the addressing optimization: the number of
+        instructions of every sequence addressingCandidates offers.
+        :return: dict from strategy name to instruction count
+        """
+        return {name: asm.count(END_LINE) for name, asm in
+                self.addressingCandidates(command, segment, index, cached)}
+
+    def renderCheapest(self, command, segment, index, cached):
+        """
+        :return: the assembly code of the sequence of addressingCandidates
+        with the fewest instructions
+        """
+        return min(self.addressingCandidates(command, segment, index, cached),
+                   key=lambda candidate: candidate[1].count(END_LINE))[1]
+
+    def fuse(self, commands, names):
+        """
+        Passes the commands through, except for the sequences writeFused
+        writes as superinstructions.
+        :param commands: iterable of (opcode, arg1, arg2) triplets.
+        :param names: list of the names the name ids of the commands refer
+        to.
+        :return: generator of the commands left to write
+        """
+        window = []
+        for command in commands:
+            window.append(command)
+            if len(window) == FUSION_WINDOW:
+                fused = self.writeFused(window, names)
+                if fused:
+                    del window[:fused]
+                else:
+                    yield window.pop(0)
+        while window:
+            fused = self.writeFused(window, names)
+            if fused:
+                del window[:fused]
+            else:
+                yield window.pop(0)
+
+    def writeFused(self, window, names):
+        """
+        Writes the command sequence starting a window of commands as a
+        superinstruction, if it matches one of the enabled patterns:
+        superinstructions:
+        push S i, push constant k, add/sub, pop S i: add k in place
+        push X, push Y, add/sub/and/or: compute X op Y in D and push it
+        push X, pop Y: copy through D
+        compare-branch:
+        [push X, push Y,] eq/gt/lt, [not], if-goto: compare and jump
+        intrinsics:
+        [push constant k,] [push X,] call Math.multiply 2 (or Math.divide)
+        tail-calls:
+        call f n, return: reuse the frame for f
+        :param window: list of (opcode, arg1, arg2) triplets
+        :param names: list of the names the name ids refer to
+        :return: the number of commands written, 0 if none matched
+        """
+        ops = [command[0] for command in window]
+        fuse = SUPERINSTRUCTIONS in self.optimizations
+        branch = COMPARE_BRANCH in self.optimizations
+        if INTRINSICS in self.optimizations:
+            fused = self.fuseIntrinsic(window, names, ops)
+            if fused:
+                return fused
+        if ops[0] == OP_CALL:
+            if TAIL_CALLS not in self.optimizations or len(ops) < 2 or \
+                    ops[1] != OP_RETURN:
+                return 0
+            self.writeTailCall(names[window[0][1]], window[0][2])
+            return 2
+        if ops[0] in (OP_EQ, OP_GT, OP_LT):
+            return branch and self.fuseBranch(window, names, ops)
+        if ops[0] != OP_PUSH or len(ops) < 2:
+            return 0
+        if ops[1] == OP_POP:
+            return fuse and self.fuseCopy(window, names)
+        if ops[1] == OP_PUSH and len(ops) >= 3:
+            return (fuse and self.fuseIncrement(window, names, ops) or
+                    branch and self.fuseBranch(window, names, ops) or
+                    fuse and self.fuseBinary(window, names, ops))
+        return 0
+
+    def renderOperands(self, window, names, command):
+        """
+        Renders the assembly code computing x op y into D, for a window
+        starting with push x, push y.
+        :param command: add, sub, and or or
+        :return: the assembly code string, or None if y can't be addressed
+        without D
+        """
+        segment, index = names[window[0][1]], window[0][2]
+        y_segment, y_index = names[window[1][1]], window[1][2]
+        with_constant, with_memory = FUSED_ARITHMETIC_C[command]
+        if y_segment == 'constant' and y_index >= 0:
+            y = '@' + str(y_index) + END_LINE + with_constant + END_LINE
+        else:
+            address = self.renderAddress(y_segment, y_index)
+            if address is None:
+                return None
+            y = address + with_memory + END_LINE
+        return self._cached_push_pop_cache(Command.C_PUSH, segment, index,
+                                           self.vm_file) + y
+
+    def fuseIncrement(self, window, names, ops):
+        """
+        push S i, push constant k, add/sub, pop S i
+        """
+        if ops[1:4] != [OP_PUSH, OP_ADD, OP_POP] and \
+                ops[1:4] != [OP_PUSH, OP_SUB, OP_POP]:
+            return 0
+        segment, index = names[window[0][1]], window[0][2]
+        (_, constant, k), (op, _, _), (_, target, target_index) = window[1:4]
+        if names[constant] != 'constant' or segment == 'constant' or \
+                names[target] != segment or target_index != index:
+            return 0
+        address = self.renderAddress(segment, index)
+        if k == 1:
+            code = ('@' + self.findMemory(segment, index) + END_LINE +
+                    ('M=M+1' if op == OP_ADD else 'M=M-1') + END_LINE)
+        elif k >= 0 and address is not None:
+            code = ('@' + str(k) + END_LINE +
+                    'D=A' + END_LINE +
+                    address +
+                    ('M=D+M' if op == OP_ADD else 'M=M-D') + END_LINE)
+        else:
+            return 0
+        self.spill()
+        self._emit(code)
+        return 4
+
+    def fuseBinary(self, window, names, ops):
+        """
+        push X, push Y, add/sub/and/or
+        """
+        if ops[2] >= OP_PUSH or \
+                ARITHMETIC_OPS[ops[2]] not in FUSED_ARITHMETIC_C:
+            return 0
+        code = self.renderOperands(window, names, ARITHMETIC_OPS[ops[2]])
+        if code is None:
+            return 0
+        self.spill()
+        self._emit(code)
+        self.cached = True
+        if TOS_CACHE not in self.optimizations:
+            self.spill()
+        return 3
+
+    def fuseBranch(self, window, names, ops):
+        """
+        [push X, push Y,] eq/gt/lt, [not], if-goto: jumps on the sign of
+        x - y without materializing the boolean.
+        """
+        operands = 2 if ops[0] == OP_PUSH else 0
+        length = operands + 1
+        if ops[operands] not in (OP_EQ, OP_GT, OP_LT):
+            return 0
+        command = ARITHMETIC_OPS[ops[operands]]
+        negate = length < len(ops) and ops[length] == OP_NOT
+        length += negate
+        if length >= len(ops) or ops[length] != OP_IF:
+            return 0
+
+        if operands:
+            code = self.renderOperands(window, names, 'sub')
+            if code is None:
+                return 0
+            self.spill()
+        else:
+            code = POP_SECOND + 'D=M-D' + END_LINE
+            if not self.cached:
+                code = POP_D + code
+        jump = (JUMP_C if negate else TRUE_JUMP_C)[command]
+        self._emit(code +
+                   '@' + self.pad_label(names[window[length][1]]) + END_LINE +
+                   jump + END_LINE)
+        self.cached = False
+        return length + 1
+
+    def fuseIntrinsic(self, window, names, ops):
+        """
+        [push constant k,] [push X,] call Math.multiply 2: multiplications
+        by a constant as shifts and adds, others through the shared
+        $$MULTIPLY routine. Math.divide by 1 is dropped, other divisions go
+        through the shared $$DIVIDE routine.
+        """
+        operands = ops.index(OP_CALL) if OP_CALL in ops[:3] else -1
+        if operands < 0 or any(op != OP_PUSH for op in ops[:operands]):
+            return 0
+        call = window[operands]
+        function_name = names[call[1]]
+        if function_name not in INTRINSIC_ROUTINES or call[2] != 2:
+            return 0
+
+        constant = None
+        if operands and names[window[0][1]] == 'constant':
+            constant = window[0][2]
+        if constant is not None and function_name == 'Math.multiply':
+            multiply = multiply_by(constant)
+            if operands == 2:
+                segment, index = names[window[1][1]], window[1][2]
+                self.spill()
+                self._emit(self._cached_push_pop_cache(
+                    Command.C_PUSH, segment, index, self.vm_file) + multiply)
+            elif self.cached:
+                self._emit(multiply)
+            elif TOS_CACHE in self.optimizations:
+                self._emit(POP_D + multiply)
+            else:
+                self._emit('@SP' + END_LINE +
+                           'A=M-1' + END_LINE +
+                           'D=M' + END_LINE +
+                           multiply +
+                           '@SP' + END_LINE +
+                           'A=M-1' + END_LINE +
+                           'M=D' + END_LINE)
+                return operands + 1
+            self.cached = True
+            if TOS_CACHE not in self.optimizations:
+                self.spill()
+            return operands + 1
+        if operands == 1 and constant == 1:  # x / 1
+            return 2
+
+        # The operands pushed before the call are written as usual
+        if operands:
+            return 0
+        self.spill()
+        self._emit(ROUTINE_CALL_C % (self.num_LTR,
+                                     INTRINSIC_ROUTINES[function_name],
+                                     self.num_LTR))
+        self.routines.add(INTRINSIC_ROUTINES[function_name])
+        self.num_LTR += 1
+        return 1
+
+    def fuseCopy(self, window, names):
+        """
+        push X, pop Y
+        """
+        segment, index = names[window[0][1]], window[0][2]
+        target, target_index = names[window[1][1]], window[1][2]
+        if target == 'constant':
+            return 0
+        self.spill()
+        if BASE_REUSE in self.optimizations:
+            self._emit(self._cached_push_pop_cache(
+                Command.C_PUSH, segment, index, self.vm_file) +
+                self.renderReused(Command.C_POP, target, target_index,
+                                  None if segment == 'constant' else
+                                  (segment, index)))
+            self.registers = ((target, target_index),) * 2
+            return 2
+        self._emit(self._cached_push_pop_cache(
+            Command.C_PUSH, segment, index, self.vm_file) +
+            self._cached_push_pop_cache(
+                Command.C_POP, target, target_index, self.vm_file))
+        return 2
+
+    def renderPushPop(self, command, segment, index, vm_file):
+        """
+        Renders the assembly code of a push or pop command. The result only
+        depends on the arguments, so it may be cached by them.
+        :param command: its C_PUSH or C_POP type command.
+        :param segment: the memory segment name.
+        :param index: the index in the given segment.
+        :param vm_file: the current file name, static addresses depend on it.
+        :return: the assembly code string
+        """
+        if ADDRESSING in self.optimizations and segment in SEGMENTS:
+            return self.renderCheapest(command, segment, index, False)
         if command == Command.C_PUSH:
             value_line = 'D=A' if segment in ['constant', 'return_address']  \
                 else 'D=M'
-            self.asm_file.write('@' + self.findMemory(segment, index) + END_LINE +
-                                value_line + END_LINE +
-                                '@SP' + END_LINE +
-                                'A=M' + END_LINE +
-                                'M=D' + END_LINE +
-                                '@SP' + END_LINE +
-                                'M=M+1' + END_LINE)
+            return ('@' + self.findMemory(segment, index) + END_LINE +
+                    value_line + END_LINE +
+                    '@SP' + END_LINE +
+                    'A=M' + END_LINE +
+                    'M=D' + END_LINE +
+                    '@SP' + END_LINE +
+                    'M=M+1' + END_LINE)
 
         elif command == Command.C_POP and segment != 'constant':
             if segment in MEMORY:
-                self.asm_file.write(
-                    '@' + self.findMemory(segment, index) + END_LINE +
-                    'D=A' + END_LINE +
-                    '@R13' + END_LINE +
-                    'M=D' + END_LINE +
-                    '@SP' + END_LINE +
-                    'AM=M-1' + END_LINE +
-                    'D=M' + END_LINE +
-                    '@R13' + END_LINE +
-                    'A=M' + END_LINE +
-                    'M=D' + END_LINE)
+                return ('@' + self.findMemory(segment, index) + END_LINE +
+                        'D=A' + END_LINE +
+                        '@R13' + END_LINE +
+                        'M=D' + END_LINE +
+                        '@SP' + END_LINE +
+                        'AM=M-1' + END_LINE +
+                        'D=M' + END_LINE +
+                        '@R13' + END_LINE +
+                        'A=M' + END_LINE +
+                        'M=D' + END_LINE)
 
             else:
-                self.asm_file.write('@SP' + END_LINE +
-                                    'AM=M-1' + END_LINE +
-                                    'D=M' + END_LINE +
-                                    '@' + self.findMemory(segment, index) + END_LINE +
-                                    'M=D' + END_LINE)
+                return ('@SP' + END_LINE +
+                        'AM=M-1' + END_LINE +
+                        'D=M' + END_LINE +
+                        '@' + self.findMemory(segment, index) + END_LINE +
+                        'M=D' + END_LINE)
+        return ''
 
     def findMemory(self, segment, index):
         """
@@ -196,11 +1378,15 @@ class CodeWriter:
         """
         Adding some suffix commands and closing the output file.
         """
-        self.asm_file.write('@END' + END_LINE +
-                            '0;JMP' + END_LINE)
-        if self.num_LTR > 0:
-            self.asm_file.write(FALSE_ACTION)
-        self.asm_file.write('(END)' + END_LINE)
+        self._emit('@END' + END_LINE +
+                   '0;JMP' + END_LINE)
+        for name, routine in ROUTINES.items():
+            if name in self.routines:
+                self._emit(routine)
+        self._emit('(END)' + END_LINE)
+        self.flush()
+        if self.assembler is not None:
+            self.asm_file.write(to_hack(self.assembler.finish()))
         self.asm_file.close()
 
     def writeInit(self):
@@ -210,7 +1396,7 @@ class CodeWriter:
 
         """
         # Set SP to 256
-        self.asm_file.write(
+        self._emit(
             "@256" + END_LINE +
             "D=A" + END_LINE +
             "@SP" + END_LINE +
@@ -228,7 +1414,8 @@ class CodeWriter:
         """
         # Write a label deceleration, using agreed upon unique label
         unique_label = self.pad_label(label=label, function=False)
-        self.asm_file.write(
+        self.spill()
+        self._emit(
             self.wrap_label(unique_label) + END_LINE
         )
 
@@ -240,9 +1427,10 @@ class CodeWriter:
         """
         # Generate agreed upon unique label
         unique_label = self.pad_label(label=label, function=function)
+        self.spill()
 
         # Write goto
-        self.asm_file.write(
+        self._emit(
             "@" + unique_label + END_LINE +
             "0;JMP" + END_LINE
         )
@@ -256,8 +1444,14 @@ class CodeWriter:
         # Generate agreed upon unique label
         unique_label = self.pad_label(label=label, function=False)
 
+        if self.cached:  # the condition is already in D
+            self._emit("@" + unique_label + END_LINE +
+                       "D;JNE" + END_LINE)
+            self.cached = False
+            return
+
         # Write conditional goto, the condition sit on stack (local?)
-        self.asm_file.write(
+        self._emit(
             "@SP" + END_LINE +
             "AM=M-1" + END_LINE +
             "D=M" + END_LINE +
@@ -274,6 +1468,11 @@ class CodeWriter:
         :param num_args: number of arguments the func accepts
 
         """
+        self.spill()
+        if TRAMPOLINES in self.optimizations:
+            self.writeTrampolineCall(function_name, num_args)
+            return
+
         # Save state of calling function f
         # return_address = self.func_specification(function_name, self.cur_label)
         # need to push return address somehow
@@ -288,64 +1487,143 @@ class CodeWriter:
         self.writePushPop(Command.C_PUSH,   'base',   MEMORY['that'])
 
         # reposition LCL to SP, ARG to SP - num_args - 5
-        self.asm_file.write('@SP' + END_LINE +
-                            'D=M' + END_LINE +
-                            '@LCL' + END_LINE +
-                            'M=D' + END_LINE +
-                            '@5' + END_LINE +
-                            'D=D-A' + END_LINE +
-                            '@' + str(num_args) + END_LINE +
-                            'D=D-A' + END_LINE +
-                            '@ARG' + END_LINE +
-                            'M=D' + END_LINE)
+        self._emit('@SP' + END_LINE +
+                   'D=M' + END_LINE +
+                   '@LCL' + END_LINE +
+                   'M=D' + END_LINE +
+                   '@5' + END_LINE +
+                   'D=D-A' + END_LINE +
+                   '@' + str(num_args) + END_LINE +
+                   'D=D-A' + END_LINE +
+                   '@ARG' + END_LINE +
+                   'M=D' + END_LINE)
 
         self.writeGoto(function_name, True)
-        self.asm_file.write(self.wrap_label(return_address) + END_LINE)
+        self._emit(self.wrap_label(return_address) + END_LINE)
         self.num_RA += 1
 
 
+    def writeTailCall(self, function_name, num_args):
+        """
+        Writes a call followed by return, which returns the value of the
+        called function to the caller as is. The called function takes over
+        the frame: its arguments are moved over the current ones, and it
+        returns directly to the caller, so the stack doesn't grow. If they
+        don't fit below the saved frame, the frame is moved up above them.
+        :param function_name: string representing the name of the function
+        :param num_args: number of arguments the func accepts
+        """
+        self.spill()
+        moved = self.num_LTR
+        jump = self.num_LTR + 1
+        self.num_LTR += 2
+        # The caller's arguments fit if LCL - ARG >= num_args + 5
+        self._emit('@LCL' + END_LINE +
+                   'D=M' + END_LINE +
+                   '@ARG' + END_LINE +
+                   'D=D-M' + END_LINE +
+                   '@' + str(num_args + 5) + END_LINE +
+                   'D=D-A' + END_LINE +
+                   '@LTR_%d' % moved + END_LINE +
+                   'D;JLT' + END_LINE)
+        if num_args:
+            self._emit(TAIL_ARGUMENTS % (num_args + 1) +
+                       COPY_NEXT * num_args)
+        self._emit('@LCL' + END_LINE +
+                   'D=M' + END_LINE +
+                   '@LTR_%d' % jump + END_LINE +
+                   '0;JMP' + END_LINE +
+                   '(LTR_%d)' % moved + END_LINE +
+                   TAIL_FRAME +
+                   TAIL_ARGUMENTS % (num_args + 1) +
+                   COPY_NEXT * (num_args + 5) +
+                   '@R14' + END_LINE +
+                   'D=M+1' + END_LINE +
+                   '@LCL' + END_LINE +
+                   'M=D' + END_LINE +
+                   # SP = LCL, where the called function starts its locals
+                   '(LTR_%d)' % jump + END_LINE +
+                   '@SP' + END_LINE +
+                   'M=D' + END_LINE +
+                   '@' + function_name + END_LINE +
+                   '0;JMP' + END_LINE)
+
+    def writeTrampolineCall(self, function_name, num_args):
+        """
+        Writes a call through the shared $$CALL routine: only the function
+        address, the number of arguments and the return address are loaded
+        at the call site.
+        :param function_name: string representing the name of the function
+        :param num_args: number of arguments the func accepts
+        """
+        return_address = "returnAddress_" + str(self.num_RA)
+        self._emit('@' + function_name + END_LINE +
+                   'D=A' + END_LINE +
+                   '@R13' + END_LINE +
+                   'M=D' + END_LINE +
+                   ('@R14' + END_LINE +
+                    'M=0' + END_LINE if num_args == 0 else
+                    '@' + str(num_args) + END_LINE +
+                    'D=A' + END_LINE +
+                    '@R14' + END_LINE +
+                    'M=D' + END_LINE) +
+                   '@' + return_address + END_LINE +
+                   'D=A' + END_LINE +
+                   '@$$CALL' + END_LINE +
+                   '0;JMP' + END_LINE +
+                   self.wrap_label(return_address) + END_LINE)
+        self.routines.add('$$CALL')
+        self.num_RA += 1
+
     def writeReturn(self):
         """
         Write the assembly code that is the translation of the return command
 
         """
-        self.asm_file.write('@LCL' + END_LINE + # frame = LCL
-                            'D=M' + END_LINE +
-                            '@frame' + END_LINE +
-                            'M=D' + END_LINE +
-                            '@5' + END_LINE + # retAddr = *(frame-5)
-                            'A=D-A' + END_LINE +
-                            'D=M' + END_LINE +
-                            '@retAddr' + END_LINE +
-                            'M=D' + END_LINE
-                            # '@SP' + END_LINE + # *ARG = pop
-                            # 'AM=M-1' + END_LINE +
-                            # 'D=M' + END_LINE +
-                            # '@ARG' + END_LINE +
-                            # 'A=M' + END_LINE +
-                            # 'M=D' + END_LINE)
-                            )
+        self.spill()
+        if TRAMPOLINES in self.optimizations:
+            self._emit('@$$RETURN' + END_LINE +
+                       '0;JMP' + END_LINE)
+            self.routines.add('$$RETURN')
+            return
+
+        self._emit('@LCL' + END_LINE + # frame = LCL
+                   'D=M' + END_LINE +
+                   '@frame' + END_LINE +
+                   'M=D' + END_LINE +
+                   '@5' + END_LINE + # retAddr = *(frame-5)
+                   'A=D-A' + END_LINE +
+                   'D=M' + END_LINE +
+                   '@retAddr' + END_LINE +
+                   'M=D' + END_LINE
+                   # '@SP' + END_LINE + # *ARG = pop
+                   # 'AM=M-1' + END_LINE +
+                   # 'D=M' + END_LINE +
+                   # '@ARG' + END_LINE +
+                   # 'A=M' + END_LINE +
+                   # 'M=D' + END_LINE)
+                   )
         self.writePushPop(Command.C_POP, 'argument', 0) # *ARG = pop
-        self.asm_file.write('@ARG' + END_LINE +  # SP = ARG + 1
-                            'D=M+1' + END_LINE +
-                            '@SP' + END_LINE +
-                            'M=D' + END_LINE)
+        self._emit('@ARG' + END_LINE +  # SP = ARG + 1
+                   'D=M+1' + END_LINE +
+                   '@SP' + END_LINE +
+                   'M=D' + END_LINE)
 
         # restores the caller's THAT, THIS, ARG, LCL
         for seg in ['THAT', 'THIS', 'ARG', 'LCL']: # make sure it works correctly
             self.fromFrameToVal(seg)
 
         # self.writeGoto('retAddr', function=True)
-        self.asm_file.write('@retAddr' + END_LINE +  # SP = ARG + 1
-                            'A=M' + END_LINE +
-                            '0;JMP' + END_LINE)
+        self._emit('@retAddr' + END_LINE +  # SP = ARG + 1
+                   'A=M' + END_LINE +
+                   '0;JMP' + END_LINE)
 
     def fromFrameToVal(self, val):
-        self.asm_file.write('@frame' + END_LINE +
-                            'AM=M-1' + END_LINE +
-                            'D=M' + END_LINE +
-                            '@' + val + END_LINE +
-                            'M=D' + END_LINE)
+        self._emit('@frame' + END_LINE +
+                   'AM=M-1' + END_LINE +
+                   'D=M' + END_LINE +
+                   '@' + val + END_LINE +
+                   'M=D' + END_LINE)
 
 
     def writeFunction(self, function_name, num_args):
@@ -357,17 +1635,12 @@ class CodeWriter:
 
         """
         self.cur_func = function_name
+        self.spill()
 
-
-        self.asm_file.write(self.wrap_label(function_name) + END_LINE)
+        self._emit(self.wrap_label(function_name) + END_LINE)
 
         # Generate n pushes into the ARG segment
-        for i in range(num_args):
-            self.asm_file.write('@SP' + END_LINE +
-                                'A=M' + END_LINE +
-                                'M=0' + END_LINE +
-                                '@SP' + END_LINE +
-                                'M=M+1' + END_LINE)
+        self._emit(PUSH_ZERO * num_args)
 
 
     @staticmethod
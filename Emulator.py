@@ -0,0 +1,245 @@
+"""
+Hack emulator for Nand to Tetris project7, HUJI
+
+Runs translated .asm (or assembled .hack) programs on an emulated Hack CPU,
+counting the cycles they take. The program is decoded once into a table of
+16 bit instruction words, and every straight run of instructions is compiled
+on first use into a Python function, so that long runs execute millions of
+cycles per second.
+
+"""
+
+import argparse
+import sys
+import time
+from array import array
+from Assembler import COMP, COMP_ALIASES, C_INSTRUCTION, AssemblyError, \
+    PREDEFINED_SYMBOLS, assemble
+
+RAM_SIZE = 65536
+WORD_MASK = 0xFFFF
+SIGN_BIT = 0x8000
+
+# Longest run of instructions compiled into a single block
+MAX_BLOCK = 256
+
+# Python expressions of the computations and jump conditions, by their bits
+COMP_EXPRESSIONS = {}
+for _comp, _bits in COMP.items():
+    if _comp not in COMP_ALIASES:
+        _expression = _comp.replace('M', 'ram[A]').replace('!', '~')
+        if _comp == '-1':
+            _expression = str(WORD_MASK)
+        elif any(operator in _comp for operator in '+-~!'):
+            _expression = '(%s) & %d' % (_expression, WORD_MASK)
+        COMP_EXPRESSIONS[_bits] = _expression
+
+JUMP_CONDITIONS = {1: '0 < v < %d' % SIGN_BIT, 2: 'v == 0',
+                   3: 'v < %d' % SIGN_BIT, 4: 'v >= %d' % SIGN_BIT,
+                   5: 'v != 0', 6: 'v == 0 or v >= %d' % SIGN_BIT,
+                   7: 'True'}
+
+
+def compile_block(rom, pc, length):
+    """
+    Compiles the instructions rom[pc:pc + length], stopping after the first
+    jump, into a Python function of (ram, A, D) returning (pc, A, D).
+    :return: (function, number of instructions compiled)
+    """
+    lines = ['def block(ram, A, D):']
+    end = min(pc + length, len(rom))
+    address = pc
+    next_pc = None
+    while address < end:
+        word = rom[address]
+        address += 1
+        if not word & SIGN_BIT:
+            lines.append('    A = %d' % word)
+            continue
+
+        expression = COMP_EXPRESSIONS.get(word >> 6 & 0x7F)
+        if expression is None:
+            raise AssemblyError("Invalid instruction word %d at %d"
+                                % (word, address - 1))
+        dest = word >> 3 & 0b111
+        jump = word & 0b111
+        if jump:
+            lines.append('    t = A')
+        lines.append('    v = ' + expression)
+        if dest & 0b001:
+            lines.append('    ram[A] = v')
+        if dest & 0b010:
+            lines.append('    D = v')
+        if dest & 0b100:
+            lines.append('    A = v')
+        if jump:
+            lines.append('    if %s:' % JUMP_CONDITIONS[jump])
+            lines.append('        return t, A, D')
+            if jump == 7:
+                next_pc = 'unreachable'
+            break
+    if next_pc is None:
+        lines.append('    return %d, A, D' % address)
+
+    namespace = {}
+    exec('\n'.join(lines), namespace)
+    return namespace['block'], address - pc
+
+
+class Emulator:
+    """
+    A Hack computer: ROM of instruction words, 16 bit RAM, and the A, D and
+    PC registers. Execution halts when the program counter leaves the
+    program (as it does at the (END) label written by CodeWriter.close) or
+    reaches an instruction that jumps to itself forever.
+
+    """
+
+    def __init__(self, rom, symbols=None):
+        """
+        :param rom: array of instruction words
+        :param symbols: symbol table of the program, for reporting
+        """
+        self.rom = rom
+        self.symbols = symbols or dict(PREDEFINED_SYMBOLS)
+        self.ram = array('H', bytes(2 * RAM_SIZE))
+        self.blocks = {}
+        self.A = self.D = self.pc = 0
+        self.cycles = 0
+        self.halted = False
+
+    @classmethod
+    def from_asm(cls, lines):
+        return cls(*assemble(lines))
+
+    @classmethod
+    def from_hack(cls, lines):
+        return cls(array('H', (int(line, 2) for line in map(str.strip, lines)
+                               if line)))
+
+    def block(self, pc, limit):
+        """
+        Returns the compiled block starting at pc, compiling it if needed.
+        :param limit: maximal number of instructions of the block
+        :return: (function, length), function is None if the block halts
+        """
+        key = pc if limit >= MAX_BLOCK else (pc, limit)
+        block = self.blocks.get(key)
+        if block is None:
+            rom = self.rom
+            if (pc + 1 < len(rom) and rom[pc] == pc and
+                    rom[pc + 1] == C_INSTRUCTION | COMP['0'] << 6 | 0b111):
+                block = (None, 0)  # @pc, 0;JMP loops forever
+            else:
+                block = compile_block(rom, pc, min(limit, MAX_BLOCK))
+            self.blocks[key] = block
+        return block
+
+    def run(self, max_cycles=None):
+        """
+        Runs the program until it halts or max_cycles more cycles passed.
+        :return: number of cycles run
+        """
+        ram = self.ram
+        A, D, pc = self.A, self.D, self.pc
+        size = len(self.rom)
+        cycles = 0
+        limit = float('inf') if max_cycles is None else max_cycles
+        block = self.block
+        blocks = self.blocks
+        try:
+            while cycles < limit:
+                if pc >= size:
+                    self.halted = True
+                    break
+                remaining = limit - cycles
+                function, length = blocks.get(pc) or block(pc, MAX_BLOCK)
+                if length > remaining:
+                    function, length = block(pc, remaining)
+                if function is None:
+                    self.halted = True
+                    break
+                pc, A, D = function(ram, A, D)
+                cycles += length
+        finally:
+            self.A, self.D, self.pc = A, D, pc
+            self.cycles += cycles
+        return cycles
+
+    def executed_addresses(self):
+        """
+        :return: set of the ROM addresses of the instructions executed so
+        far. Blocks are compiled when first reached and run whole up to
+        their final jump, so these are the addresses of the compiled blocks.
+        """
+        addresses = set()
+        for key, (function, length) in self.blocks.items():
+            pc = key if isinstance(key, int) else key[0]
+            addresses.update(range(pc, pc + length))
+        return addresses
+
+    def address(self, name):
+        """
+        :param name: a RAM address or a symbol of the program
+        :return: int
+        """
+        return int(name) if name.isdigit() else self.symbols[name]
+
+    def value(self, address):
+        """
+        :return: the signed value of a RAM word
+        """
+        word = self.ram[address]
+        return word - (word & SIGN_BIT) * 2
+
+
+def parse_assignment(text):
+    name, _, value = text.partition('=')
+    return name, int(value)
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(
+        description="Runs a Hack program, reporting the cycles it took and "
+                    "its final RAM.")
+    arg_parser.add_argument("program", help="file_name.asm or file_name.hack")
+    arg_parser.add_argument("--cycles", type=int,
+                            help="stop after N cycles if still running")
+    arg_parser.add_argument("--set", action="append", default=[],
+                            type=parse_assignment, metavar="ADDRESS=VALUE",
+                            help="initial RAM value, e.g. --set SP=256")
+    arg_parser.add_argument("--dump", default="0-15",
+                            help="comma separated RAM addresses, ranges or "
+                                 "symbols to print, default 0-15")
+    args = arg_parser.parse_args(argv)
+
+    with open(args.program) as fp:
+        if args.program.endswith('.hack'):
+            emulator = Emulator.from_hack(fp)
+        else:
+            emulator = Emulator.from_asm(fp)
+
+    for name, value in args.set:
+        emulator.ram[emulator.address(name)] = value & WORD_MASK
+
+    start = time.perf_counter()
+    emulator.run(args.cycles)
+    elapsed = time.perf_counter() - start
+
+    print("Cycles: %d (%s)" % (emulator.cycles, "halted" if emulator.halted
+                                else "stopped at pc %d" % emulator.pc))
+    print("Instructions executed: %d distinct of %d" % (
+        len(emulator.executed_addresses()), len(emulator.rom)))
+    print("Time: %.3fs, %.0f cycles/sec" % (
+        elapsed, emulator.cycles / elapsed if elapsed else 0))
+    for item in args.dump.split(','):
+        first, _, last = item.partition('-')
+        first = emulator.address(first)
+        last = emulator.address(last) if last else first
+        for address in range(first, last + 1):
+            print("RAM[%d] = %d" % (address, emulator.value(address)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
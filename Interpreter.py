@@ -0,0 +1,376 @@
+"""
+VM interpreter for Nand to Tetris project7, HUJI
+
+Executes parsed .vm programs directly, without translating them to assembly.
+Memory follows the segment mapping of CodeWriter.findMemory and the call
+frame layout of CodeWriter.writeCall/writeReturn. Labels, functions and
+static variables are resolved once when the program is loaded, and every
+basic block is compiled on first use into a Python function that keeps the
+stack in local variables, pushing to memory only across blocks.
+
+"""
+
+import argparse
+import os
+import sys
+import time
+from array import array
+from itertools import count
+from Parser import *
+from Assembler import FIRST_VARIABLE, PREDEFINED_SYMBOLS
+from Emulator import SIGN_BIT, WORD_MASK, parse_assignment
+
+RAM_SIZE = 65536
+STACK_BASE = 256
+TEMP_BASE = 5
+FRAME_SIZE = 5
+
+SP, LCL, ARG, THIS, THAT = range(5)
+
+# Base pointer address of the segments addressed through one
+BASES = {'local': LCL, 'argument': ARG, 'this': THIS, 'that': THAT}
+
+# Python expressions of the arithmetic commands on 16 bit words x and y,
+# comparisons test the sign of the 16 bit x - y as the translated code
+# does, which wraps when the difference overflows
+BINARY_EXPRESSIONS = {OP_ADD: '(%(x)s + %(y)s) & 65535',
+                      OP_SUB: '(%(x)s - %(y)s) & 65535',
+                      OP_AND: '%(x)s & %(y)s',
+                      OP_OR: '%(x)s | %(y)s',
+                      OP_EQ: '65535 if %(x)s == %(y)s else 0',
+                      OP_GT: '65535 if 0 < (%(x)s - %(y)s) & 65535 < 32768 '
+                             'else 0',
+                      OP_LT: '65535 if (%(x)s - %(y)s) & 32768 else 0'}
+
+UNARY_EXPRESSIONS = {OP_NEG: '-%(x)s & 65535',
+                     OP_NOT: '%(x)s ^ 65535'}
+
+
+class VMError(Exception):
+    """
+    Raised when a vm program can't be loaded or executed.
+
+    """
+
+
+class Interpreter:
+    """
+    Loads the programs of one or more vm files into a single code table and
+    executes it. Memory words hold 16 bit values as 0..65535, except for the
+    return addresses of frames, which are indices into the code table.
+
+    """
+
+    def __init__(self, files, bootstrap=False):
+        """
+        :param files: list of (file name, Program) pairs, sharing a NameTable
+        :param bootstrap: if True, start like the translator's bootstrap
+        code: set SP to 256 and call Sys.init.
+        """
+        self.ops = array('B')
+        self.arg1 = []
+        self.arg2 = array('i')
+        self.symbols = dict(PREDEFINED_SYMBOLS)
+        self.link(files)
+
+        self.mem = array('i', bytes(4 * RAM_SIZE))
+        self.blocks = {}
+        self.index = 0
+        self.executed = 0
+        self.halted = False
+        if bootstrap:
+            self.call_init()
+
+    @classmethod
+    def from_paths(cls, paths, bootstrap=None):
+        """
+        :param paths: vm file paths
+        :param bootstrap: as in __init__, by default only for several files
+        """
+        names = NameTable()
+        files = [(os.path.splitext(os.path.basename(path))[0],
+                  Parser(path, names).program) for path in paths]
+        if bootstrap is None:
+            bootstrap = len(paths) > 1
+        return cls(files, bootstrap)
+
+    def link(self, files):
+        """
+        Concatenates the files into the code table, dropping labels and
+        resolving every name: segments of push/pop to (segment, index or
+        static address), labels and functions to code indices.
+        """
+        labels = {}
+        functions = {}
+        jumps = []
+        next_static = count(FIRST_VARIABLE)
+        cur_func = ""
+        for file_name, program in files:
+            names = program.names
+            for op, arg1, arg2 in program.commands():
+                if op == OP_LABEL:
+                    labels[cur_func + "$" + names[arg1]] = len(self.ops)
+                    continue
+                if op in (OP_PUSH, OP_POP):
+                    arg1 = names[arg1]
+                    if arg1 == 'static':
+                        static = "%s.%d" % (file_name, arg2)
+                        if static not in self.symbols:
+                            self.symbols[static] = next(next_static)
+                        arg2 = self.symbols[static]
+                elif op in (OP_GOTO, OP_IF):
+                    arg1 = cur_func + "$" + names[arg1]
+                    jumps.append(len(self.ops))
+                elif op == OP_CALL:
+                    arg1 = names[arg1]
+                    jumps.append(len(self.ops))
+                elif op == OP_FUNCTION:
+                    cur_func = arg1 = names[arg1]
+                    functions[cur_func] = len(self.ops)
+                self.ops.append(op)
+                self.arg1.append(arg1)
+                self.arg2.append(arg2)
+
+        for index in jumps:
+            name = self.arg1[index]
+            target = (functions if self.ops[index] == OP_CALL else
+                      labels).get(name)
+            if target is None:
+                raise VMError("Undefined %s: %s" % (
+                    "function" if self.ops[index] == OP_CALL else "label",
+                    name))
+            self.arg1[index] = target
+
+        # Blocks start at every label, function and return address
+        self.entries = set(labels.values()) | set(functions.values())
+        self.entries.update(index + 1 for index in jumps
+                            if self.ops[index] == OP_CALL)
+        self.functions = functions
+
+    def call_init(self):
+        """
+        Sets up the stack and the frame of a call to Sys.init, returning to
+        the end of the code so that the program halts if it ever returns.
+        """
+        if 'Sys.init' not in self.functions:
+            raise VMError("Undefined function: Sys.init")
+        mem = self.mem
+        sp = STACK_BASE
+        mem[sp] = len(self.ops)
+        sp += FRAME_SIZE
+        mem[SP] = mem[LCL] = sp
+        mem[ARG] = sp - FRAME_SIZE
+        self.index = self.functions['Sys.init']
+
+    @staticmethod
+    def address(segment, index):
+        """
+        :return: Python expression of the address of a segment entry
+        """
+        if segment in BASES:
+            return 'mem[%d] + %d' % (BASES[segment], index)
+        if segment == 'temp':
+            return str(TEMP_BASE + index)
+        if segment == 'pointer':
+            return str(THAT if index else THIS)
+        return str(index)  # static, resolved at link time
+
+    def compile_block(self, start):
+        """
+        Compiles the commands from start up to the next block entry or
+        jump into a Python function of mem returning (next index, number of
+        commands executed). The stack is simulated at compile time: pushed
+        values live in locals, and only reach memory at the end of the block
+        or before leaving it.
+        :return: function, or None if the block loops forever in place
+        """
+        ops, arg1, arg2 = self.ops, self.arg1, self.arg2
+        if ops[start] == OP_GOTO and arg1[start] == start:
+            return None
+
+        lines = ['def block(mem):', '    sp = mem[0]']
+        stack = []
+        temps = count()
+
+        def emit(line):
+            lines.append('    ' + line)
+
+        def load(expression):
+            name = 't%d' % next(temps)
+            emit('%s = %s' % (name, expression))
+            return name
+
+        def operand():
+            if stack:
+                return stack.pop()
+            emit('sp -= 1')
+            return load('mem[sp]')
+
+        def flush():
+            for offset, value in enumerate(stack):
+                emit('mem[sp + %d] = %s' % (offset, value))
+            if stack:
+                emit('sp += %d' % len(stack))
+            stack.clear()
+
+        def leave(target, executed):
+            emit('mem[0] = sp')
+            emit('return %s, %d' % (target, executed))
+
+        index = start
+        size = len(ops)
+        while index < size and (index == start or index not in self.entries):
+            op, first, second = ops[index], arg1[index], arg2[index]
+            index += 1
+            executed = index - start
+
+            if op == OP_PUSH:
+                if first == 'constant':
+                    stack.append(str(second & WORD_MASK))
+                else:
+                    stack.append(load('mem[%s]' % self.address(first,
+                                                               second)))
+            elif op == OP_POP:
+                value = operand()
+                if first != 'constant':
+                    emit('mem[%s] = %s' % (self.address(first, second),
+                                           value))
+            elif op in BINARY_EXPRESSIONS:
+                y = operand()
+                x = operand()
+                stack.append(load(BINARY_EXPRESSIONS[op] % {'x': x, 'y': y}))
+            elif op in UNARY_EXPRESSIONS:
+                stack.append(load(UNARY_EXPRESSIONS[op] % {'x': operand()}))
+            elif op == OP_GOTO:
+                flush()
+                leave(first, executed)
+                break
+            elif op == OP_IF:
+                condition = operand()
+                flush()
+                emit('if %s:' % condition)
+                emit('    mem[0] = sp')
+                emit('    return %d, %d' % (first, executed))
+            elif op == OP_FUNCTION:
+                # Locals live on the stack, so they must reach memory now
+                stack.extend('0' * second)
+                flush()
+            elif op == OP_CALL:
+                flush()
+                emit('mem[sp] = %d' % index)
+                for offset in range(1, FRAME_SIZE):
+                    emit('mem[sp + %d] = mem[%d]' % (offset, offset))
+                emit('mem[%d] = sp - %d' % (ARG, second))
+                emit('sp += %d' % FRAME_SIZE)
+                emit('mem[%d] = sp' % LCL)
+                leave(first, executed)
+                break
+            elif op == OP_RETURN:
+                value = operand()
+                emit('frame = mem[%d]' % LCL)
+                emit('ret = mem[frame - %d]' % FRAME_SIZE)
+                emit('mem[mem[%d]] = %s' % (ARG, value))
+                emit('sp = mem[%d] + 1' % ARG)
+                for pointer in (THAT, THIS, ARG, LCL):
+                    emit('mem[%d] = mem[frame - %d]' % (pointer,
+                                                        FRAME_SIZE - pointer))
+                leave('ret', executed)
+                break
+        else:
+            flush()
+            leave(index, index - start)
+
+        namespace = {}
+        exec('\n'.join(lines), namespace)
+        return namespace['block']
+
+    def run(self, max_commands=None):
+        """
+        Runs the program until it halts or about max_commands more commands
+        were executed (whole blocks are always run).
+        :return: number of commands executed
+        """
+        mem = self.mem
+        blocks = self.blocks
+        size = len(self.ops)
+        index = self.index
+        executed = 0
+        limit = float('inf') if max_commands is None else max_commands
+        try:
+            while executed < limit:
+                if index >= size:
+                    self.halted = True
+                    break
+                block = blocks.get(index, False)
+                if block is False:
+                    block = blocks[index] = self.compile_block(index)
+                if block is None:
+                    self.halted = True
+                    break
+                index, commands = block(mem)
+                executed += commands
+        finally:
+            self.index = index
+            self.executed += executed
+        return executed
+
+    def value(self, address):
+        """
+        :return: the signed value of a memory word
+        """
+        word = self.mem[address] & WORD_MASK
+        return word - (word & SIGN_BIT) * 2
+
+
+def main(argv=None):
+    from Main import filter_paths, FILE_EXTENSION_VM
+
+    arg_parser = argparse.ArgumentParser(
+        description="Runs a vm program directly, reporting the commands it "
+                    "executed and its final memory.")
+    arg_parser.add_argument("path", help="file_name.vm or /existing_dir_path/")
+    arg_parser.add_argument("--commands", type=int,
+                            help="stop after about N commands if still "
+                                 "running")
+    arg_parser.add_argument("--set", action="append", default=[],
+                            type=parse_assignment, metavar="ADDRESS=VALUE",
+                            help="initial memory value, e.g. --set SP=256")
+    arg_parser.add_argument("--dump", default="0-15",
+                            help="comma separated addresses, ranges or "
+                                 "symbols (e.g. Main.0) to print")
+    args = arg_parser.parse_args(argv)
+
+    if os.path.isdir(args.path):
+        paths = sorted(filter_paths(args.path))
+    elif args.path.endswith(FILE_EXTENSION_VM):
+        paths = [args.path]
+    else:
+        arg_parser.error("Please supply .vm filename or dir.")
+    interpreter = Interpreter.from_paths(paths)
+
+    def address(name):
+        return int(name) if name.isdigit() else interpreter.symbols[name]
+
+    for name, value in args.set:
+        interpreter.mem[address(name)] = value & WORD_MASK
+
+    start = time.perf_counter()
+    interpreter.run(args.commands)
+    elapsed = time.perf_counter() - start
+
+    print("Commands executed: %d (%s)" % (
+        interpreter.executed, "halted" if interpreter.halted else
+        "stopped at command %d" % interpreter.index))
+    print("Time: %.3fs, %.0f commands/sec" % (
+        elapsed, interpreter.executed / elapsed if elapsed else 0))
+    for item in args.dump.split(','):
+        first, _, last = item.partition('-')
+        first = address(first)
+        last = address(last) if last else first
+        for addr in range(first, last + 1):
+            print("RAM[%d] = %d" % (addr, interpreter.value(addr)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,29 +7,72 @@ Authors: Shimon Heimowitz, Karin Sorokin
 
 """
 
-import sys
+import argparse
+import io
 import os
+import sys
 import traceback
-from Parser import Parser, Command, Arithmetic
-from CodeWriter import CodeWriter
-
-FILE_PATH = 1
+from concurrent.futures import ProcessPoolExecutor
+from Parser import Parser, NameTable
+from CodeWriter import CodeWriter, GOALS, SHARED_COMPARE, TRAMPOLINES, \
+    PEEPHOLE, CONSTANT_FOLDING, DEAD_FUNCTIONS, INLINE, WHOLE_PROGRAM, \
+    TOS_CACHE, SUPERINSTRUCTIONS, COMPARE_BRANCH, TAIL_CALLS, INTRINSICS, \
+    INTRINSIC_CALLS, CONTROL_FLOW, ADDRESSING, BASE_REUSE
+from Optimizer import eliminate_dead_functions, inline_functions, \
+    remove_functions, INLINE_SIZE
+from Peephole import RULES
+from Cache import TranslationCache
+from Stats import Stats
 
 FILE_EXTENSION_ASM = '.asm'
+FILE_EXTENSION_HACK = '.hack'
 FILE_EXTENSION_VM = '.vm'
 
+# Names accepted by --optimize
+OPTIMIZATIONS = ((SHARED_COMPARE,
+                  TRAMPOLINES,
+                  PEEPHOLE,
+                  CONSTANT_FOLDING,
+                  DEAD_FUNCTIONS,
+                  INLINE,
+                  TOS_CACHE,
+                  SUPERINSTRUCTIONS,
+                  COMPARE_BRANCH,
+                  TAIL_CALLS,
+                  INTRINSICS,
+                  CONTROL_FLOW,
+                  ADDRESSING,
+                  BASE_REUSE) +
+                 tuple(PEEPHOLE + ':' + rule for rule in RULES))
+
 
-def main(path):
+def main(path, stream=False, jobs=1, cache_dir=None, stats=None,
+         hack=False, optimizations=()):
     """
     Main translater. Checks legality of arguments and operates on directory
     or file accordingly.
     :param path: argument
+    :param stream: if True, files are parsed lazily through a fixed size
+    buffer instead of being read whole.
+    :param jobs: number of processes translating the files of a directory,
+    None for one per core.
+    :param cache_dir: if given, the translation of each file is cached in
+    this directory and only changed files are translated again.
+    :param stats: a Stats object gathering statistics of the translation, or
+    None. Statistics are gathered in this process, so jobs and cache_dir are
+    ignored.
+    :param hack: if True, the translation is assembled and written as a
+    .hack file of machine code instead of a .asm file.
+    :param optimizations: names of the optional code generation strategies
+    to use. Whole program optimizations parse all the files of a directory
+    first, in this process, so stream, jobs and cache_dir are ignored.
+    :return: True iff the translation succeeded
     """
     vm_files = []
     if not os.path.exists(path):
         print("Error: File or directory does not exist: %s"
               % path)
-        return
+        return False
 
     elif os.path.isdir(path):  # Directory of files
         vm_files = filter_paths(path)
@@ -38,13 +81,13 @@ def main(path):
         if not vm_files:  # no vm files found
             print("Error: No files matching %s found in supplied "
                   "directory: %s" % (FILE_EXTENSION_VM, path))
-            return
+            return False
 
     elif os.path.isfile(path):  # Single file
         if not path.endswith(FILE_EXTENSION_VM):
             print("Error: Mismatched file type.\n\"%s\"suffix is not a valid "
                   "file type. Please supply .vm filename or dir." % path)
-            return
+            return False
         vm_files.append(path)
         dir_path = os.path.dirname(path)
         file_name = os.path.splitext(os.path.basename(path))[0] + \
@@ -53,26 +96,44 @@ def main(path):
     else:
         print("Error: Unrecognized path: \"%s\"\n"
               "Please supply dir or path/filename.vm")
-        return
+        return False
+
+    if hack:
+        file_name = os.path.splitext(file_name)[0] + FILE_EXTENSION_HACK
 
     try:
         # Initilizes write based, using a condition for multiple file reading.
         # Multiple files have a special initlization
         writer = CodeWriter(os.path.join(dir_path, file_name),
-                            len(vm_files) > 1)
-        for vm_file in vm_files:
-            translate_file(vm_file, writer)
+                            len(vm_files) > 1, stats, hack, optimizations)
+        if len(vm_files) > 1 and any(
+                name.partition(':')[0] in WHOLE_PROGRAM
+                for name in optimizations):
+            translate_whole_program(vm_files, writer, stats)
+        elif stats is not None:
+            for vm_file in vm_files:
+                translate_file(vm_file, writer, stream, stats)
+        elif cache_dir is not None:
+            translate_cached(vm_files, writer,
+                             TranslationCache(cache_dir, optimizations),
+                             stream, jobs)
+        elif len(vm_files) > 1 and jobs != 1:
+            translate_parallel(vm_files, writer, stream, jobs)
+        else:
+            for vm_file in vm_files:
+                translate_file(vm_file, writer, stream)
         writer.close()
+        return True
 
     except OSError:
         print("Could not open some file.\n "
               "If file exists, check spelling of file path.")
-        return
+        return False
 
     except Exception as e:
         print("Some exception occurred while parsing.", e)
         traceback.print_exc()
-        return
+        return False
 
 
 def filter_paths(path):
@@ -83,46 +144,309 @@ def filter_paths(path):
             f.endswith(FILE_EXTENSION_VM)]
 
 
-def translate_file(path, writer):
+def translate_file(path, writer, stream=False, stats=None):
     """
     Translates from virtual machine language files and creates a relevant .asm
     file.
     :param path: Path of current file to translate
     :param writer: A write to translate all files.
+    :param stream: if True, commands are streamed into the writer as they are
+    parsed, keeping memory use constant regardless of the file size.
+    :param stats: a Stats object timing the parsing, or None
     :return:
     """
-    parser = Parser(path)
     parsed_name = os.path.splitext(os.path.basename(path))[0]
     writer.setFileName(parsed_name)
-    while parser.hasMoreCommands():
-        parser.advance()
-        if parser.commandType() == Command.C_ARITHMETIC:
-            writer.writeArithmetic(parser.arg1())
-        if parser.commandType() in (Command.C_PUSH, Command.C_POP):
-            writer.writePushPop(parser.commandType(),
-                                parser.arg1(), parser.arg2())
-        if parser.commandType() == Command.C_LABEL:
-            writer.writeLabel(parser.arg1())
+    if stream:
+        names = NameTable()
+        commands = Parser.stream(path, names)
+        if stats is not None:
+            commands = stats.timed_stream(commands)
+        writer.writeCommands(commands, names)
+    elif stats is not None:
+        writer.writeProgram(stats.timed_parse(Parser, path).program)
+    else:
+        writer.writeProgram(Parser(path).program)
+
+
+def translate_whole_program(paths, writer, stats=None):
+    """
+    Parses all the files of a program before translating them, so that
+    functions can be inlined into other files, and with dead-functions
+    dropping the functions that can't be reached from Sys.init.
+    :param paths: Paths of the files to translate
+    :param writer: A write to translate all files.
+    :param stats: a Stats object timing the parsing, or None
+    """
+    if stats is not None:
+        programs = [stats.timed_parse(Parser, path).program for path in paths]
+    else:
+        programs = [Parser(path).program for path in paths]
+
+    intrinsics = INTRINSIC_CALLS if INTRINSICS in writer.optimizations \
+        else ()
+    size = inline_size(writer.optimizations)
+    if size:
+        programs, inlined, callees = inline_functions(programs, size,
+                                                      intrinsics)
+        if inlined:
+            print("Inlined %d calls" % inlined)
+        if DEAD_FUNCTIONS not in writer.optimizations:
+            programs, removed = remove_functions(programs, callees)
+            if removed:
+                print("Removed %d inlined functions: %s"
+                      % (len(removed), ", ".join(removed)))
+
+    if DEAD_FUNCTIONS in writer.optimizations:
+        programs, removed = eliminate_dead_functions(programs,
+                                                     intrinsics=intrinsics)
+        if removed:
+            print("Removed %d unreachable functions: %s"
+                  % (len(removed), ", ".join(removed)))
+
+    for path, program in zip(paths, programs):
+        writer.setFileName(os.path.splitext(os.path.basename(path))[0])
+        writer.writeProgram(program)
 
-        if parser.commandType() == Command.C_GOTO:
-            writer.writeGoto(parser.arg1())
 
-        if parser.commandType() == Command.C_IF:
-            writer.writeIf(parser.arg1())
+def inline_size(optimizations):
+    """
+    :param optimizations: names of the optimizations in use
+    :return: the size of the largest function to inline, 0 for none
+    """
+    size = 0
+    for name in optimizations:
+        base, _, limit = name.partition(':')
+        if base == INLINE:
+            size = max(size, int(limit) if limit else INLINE_SIZE)
+    return size
 
-        if parser.commandType() == Command.C_RETURN:
-            writer.writeReturn()
 
-        if parser.commandType() == Command.C_CALL:
-            writer.writeCall(parser.arg1(), parser.arg2())
+def translate_fragment(path, stream=False, optimizations=()):
+    """
+    Translates a single file into memory, for merging by another writer.
+    Labels outside of any function are not carried over between files.
+    :param path: Path of the file to translate
+    :param stream: if True, commands are streamed into the writer as they are
+    parsed.
+    :param optimizations: names of the optional code generation strategies
+    to use.
+    :return: (asm, num_LTR, num_RA, routines) of the translated file
+    """
+    writer = CodeWriter(io.StringIO(), optimizations=optimizations)
+    translate_file(path, writer, stream)
+    return writer.fragment()
+
 
-        if parser.commandType() == Command.C_FUNCTION:
-            writer.writeFunction(parser.arg1(), parser.arg2())
+def translate_fragments(paths, stream=False, jobs=None, optimizations=()):
+    """
+    Translates files into fragments, in a process pool if there are several.
+    :param paths: Paths of the files to translate
+    :param stream: if True, commands are streamed as they are parsed.
+    :param jobs: number of processes, None for one per core.
+    :param optimizations: names of the optional code generation strategies
+    to use.
+    :return: list of (asm, num_LTR, num_RA, routines) in the order of paths
+    """
+    if len(paths) < 2 or jobs == 1:
+        return [translate_fragment(path, stream, optimizations)
+                for path in paths]
+    with ProcessPoolExecutor(jobs) as executor:
+        return list(executor.map(translate_fragment, paths,
+                                 [stream] * len(paths),
+                                 [optimizations] * len(paths)))
+
+
+def translate_parallel(paths, writer, stream=False, jobs=None):
+    """
+    Translates files in a process pool, merging the results in order into
+    the writer. The output is identical to translating them one by one.
+    :param paths: Paths of the files to translate
+    :param writer: A write to translate all files.
+    :param stream: if True, commands are streamed as they are parsed.
+    :param jobs: number of processes, None for one per core.
+    """
+    for fragment in translate_fragments(paths, stream, jobs,
+                                        writer.optimizations):
+        writer.writeFragment(*fragment)
+
+
+def translate_cached(paths, writer, cache, stream=False, jobs=1):
+    """
+    Translates files through a TranslationCache: only files whose content
+    changed are translated, the others are read back from the cache.
+    :param paths: Paths of the files to translate
+    :param writer: A write to translate all files.
+    :param cache: TranslationCache
+    :param stream: if True, commands are streamed as they are parsed.
+    :param jobs: number of processes for the changed files, None for one
+    per core.
+    """
+    keys = [cache.key(path) for path in paths]
+    fragments = [cache.load(key) for key in keys]
+    missing = [i for i, fragment in enumerate(fragments) if fragment is None]
+
+    translated = translate_fragments([paths[i] for i in missing], stream,
+                                     jobs, writer.optimizations)
+    for i, fragment in zip(missing, translated):
+        cache.store(keys[i], fragment)
+        fragments[i] = fragment
+
+    for fragment in fragments:
+        writer.writeFragment(*fragment)
+
+
+def batch(paths, stream=False, jobs=None, cache_dir=None, hack=False,
+          optimizations=()):
+    """
+    Translates many programs (vm files or directories) in a pool of worker
+    processes, so that the interpreter is only started once. A failing
+    program does not stop the others.
+    :param paths: paths of the programs to translate
+    :param stream: if True, files are parsed lazily through a fixed size
+    buffer.
+    :param jobs: number of processes, None for one per core. With 1 the
+    programs are translated in this process.
+    :param cache_dir: directory of a translation cache shared by all the
+    programs, or None.
+    :param hack: if True, programs are written as .hack machine code.
+    :param optimizations: names of the optional code generation strategies
+    to use.
+    :return: list of (path, success) pairs in the order of paths
+    """
+    if jobs == 1:
+        return [(path, run_safely(path, stream, cache_dir, hack,
+                                  optimizations))
+                for path in paths]
+
+    with ProcessPoolExecutor(jobs) as executor:
+        futures = [executor.submit(run_safely, path, stream, cache_dir, hack,
+                                   optimizations)
+                   for path in paths]
+        results = []
+        for path, future in zip(paths, futures):
+            try:
+                results.append((path, future.result()))
+            except Exception as e:  # the worker itself died
+                print("Error: Worker failed on %s: %s" % (path, e))
+                results.append((path, False))
+        return results
+
+
+def run_safely(path, stream=False, cache_dir=None, hack=False,
+               optimizations=()):
+    """
+    Runs main on a single program of a batch, turning any escaping error into
+    a failure.
+    :return: True iff the translation succeeded
+    """
+    try:
+        return main(path, stream, cache_dir=cache_dir, hack=hack,
+                    optimizations=optimizations)
+    except Exception as e:
+        print("Some exception occurred while translating %s." % path, e)
+        return False
+
+
+def read_manifest(manifest):
+    """
+    Reads the program paths listed in a manifest file, one per line. Empty
+    lines and lines starting with # are skipped, relative paths are relative
+    to the manifest's directory.
+    :param manifest: path of the manifest file
+    :return: list of paths
+    """
+    base = os.path.dirname(manifest)
+    with open(manifest) as fp:
+        return [os.path.join(base, line.strip()) for line in fp
+                if line.strip() and not line.lstrip().startswith('#')]
+
+
+def optimization(name):
+    """
+    Checks the name given to --optimize.
+    :return: the name
+    """
+    base, _, limit = name.partition(':')
+    if name not in OPTIMIZATIONS and not (base == INLINE and limit.isdigit()):
+        raise argparse.ArgumentTypeError("unknown optimization: %s" % name)
+    return name
+
+
+def parse_arguments(argv=None):
+    """
+    Parses the command line arguments.
+    :param argv: list of arguments, sys.argv if None
+    :return: argparse.Namespace
+    """
+    arg_parser = argparse.ArgumentParser(
+        prog="VMtranslator",
+        description="Translates .vm files to a Hack .asm file.")
+    arg_parser.add_argument("paths", nargs="*", metavar="path",
+                            help="file_name.vm or /existing_dir_path/, "
+                                 "several are translated as a batch")
+    arg_parser.add_argument("--manifest",
+                            help="file listing more paths to translate as a "
+                                 "batch, one per line")
+    arg_parser.add_argument("--hack", action="store_true",
+                            help="assemble the translation in memory and "
+                                 "write .hack machine code instead of .asm")
+    arg_parser.add_argument("--stream", action="store_true",
+                            help="parse files lazily through a fixed size "
+                                 "buffer, for very large inputs")
+    arg_parser.add_argument("--cache", metavar="DIR",
+                            help="cache the translation of every file in DIR "
+                                 "and only translate changed files again")
+    arg_parser.add_argument("--stats", metavar="FILE",
+                            help="dump per command statistics of the "
+                                 "translation as JSON to FILE, - for stdout")
+    arg_parser.add_argument("-O", "--optimize", action="append",
+                            default=[], type=optimization, metavar="NAME",
+                            help="enable an optional code generation "
+                                 "strategy, one of: %s, or %s:N to inline "
+                                 "functions of up to N commands" %
+                                 (", ".join(OPTIMIZATIONS), INLINE))
+    arg_parser.add_argument("--optimize-for", choices=sorted(GOALS),
+                            help="enable the optimizations of a goal: "
+                                 "speed, or size at a small cost in speed")
+    arg_parser.add_argument("-j", "--jobs", type=int, default=1,
+                            help="translate the files of a directory (or "
+                                 "the programs of a batch) in N processes, "
+                                 "0 for one per core")
+    args = arg_parser.parse_args(argv)
+    if args.manifest:
+        args.paths += read_manifest(args.manifest)
+    args.optimizations = tuple(sorted(set(args.optimize) | set(
+        GOALS[args.optimize_for] if args.optimize_for else ())))
+    if not args.paths:
+        arg_parser.error("Wrong number of arguments.\n"
+                         "Usage: VMTranslator file_name.vm or "
+                         "/existing_dir_path/")
+    return args
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Error: Wrong number of arguments.\n"
-              "Usage: VMTranslator file_name.vm or /existing_dir_path/")
-    else:
-        main(sys.argv[FILE_PATH])
+    args = parse_arguments()
+    jobs = args.jobs or None
+    if len(args.paths) == 1:
+        stats = Stats() if args.stats else None
+        success = main(args.paths[0], stream=args.stream, jobs=jobs,
+                       cache_dir=args.cache, stats=stats, hack=args.hack,
+                       optimizations=args.optimizations)
+        if success and stats is not None:
+            if args.stats == '-':
+                stats.dump(sys.stdout)
+            else:
+                with open(args.stats, 'w') as fp:
+                    stats.dump(fp)
+        sys.exit(not success)
+
+    results = batch(args.paths, stream=args.stream, jobs=jobs,
+                    cache_dir=args.cache, hack=args.hack,
+                    optimizations=args.optimizations)
+    failed = [path for path, success in results if not success]
+    for path, success in results:
+        print("%s: %s" % ("OK" if success else "FAILED", path))
+    print("%d of %d programs translated" % (len(results) - len(failed),
+                                            len(results)))
+    sys.exit(bool(failed))
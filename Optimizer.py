@@ -0,0 +1,581 @@
+"""
+VM optimizer for Nand to Tetris project7, HUJI
+
+Passes over parsed vm commands, run before code generation. Every pass
+takes and returns an iterable of (opcode, arg1, arg2) triplets, as produced
+by Program.commands() or Parser.stream(), so passes can be chained and
+work on streamed files as well.
+
+"""
+
+from Parser import *
+
+WORD_MASK = 0xFFFF
+SIGN_BIT = 0x8000
+
+CONSTANT = SEGMENTS.index('constant')
+
+# The smallest constant CodeWriter can push is -32767 (@32767, A=-A)
+MIN_CONSTANT = -0x7FFF
+
+# gt and lt test the sign of x - y as CodeWriter does, which wraps when the
+# difference doesn't fit in 16 bits
+BINARY_OPS = {OP_ADD: lambda x, y: x + y,
+              OP_SUB: lambda x, y: x - y,
+              OP_AND: lambda x, y: x & y,
+              OP_OR: lambda x, y: x | y,
+              OP_EQ: lambda x, y: -(x == y),
+              OP_GT: lambda x, y: -(to_signed(x - y) > 0),
+              OP_LT: lambda x, y: -(to_signed(x - y) < 0)}
+
+UNARY_OPS = {OP_NEG: lambda x: -x,
+             OP_NOT: lambda x: ~x}
+
+# Largest number of commands of a function inlined by default
+INLINE_SIZE = 16
+
+# Largest number of commands added to move the arguments, zero the locals
+# and save THIS/THAT of an inlined call. The call and return themselves
+# cost about as much as ten push/pop commands.
+INLINE_OVERHEAD = 8
+
+# Commands ending a basic block
+ENDS_BLOCK = (OP_GOTO, OP_IF, OP_RETURN)
+
+# Binary operations that leave x unchanged with this constant as y
+IDENTITIES = {OP_ADD: 0, OP_SUB: 0, OP_OR: 0, OP_AND: -1}
+
+
+def to_signed(value):
+    """
+    :return: value as a 16 bit two's complement word, in -32768..32767
+    """
+    value &= WORD_MASK
+    return value - (value & SIGN_BIT) * 2
+
+
+def push_constant(value):
+    return OP_PUSH, CONSTANT, value
+
+
+def fold_constants(commands):
+    """
+    Folds arithmetic on constants, with the 16 bit semantics of the Hack
+    ALU: push constant 2, push constant 3, add becomes push constant 5, and
+    so on through chains of operations. Also drops identities (x + 0,
+    x & -1, ...), double neg and not, and resolves if-goto on a constant
+    into a goto or nothing.
+    :param commands: iterable of (opcode, arg1, arg2) triplets
+    :return: generator of the folded triplets
+    """
+    # Commands that may still be folded with the next ones: a run of pushed
+    # constants, or a single unary operation
+    out = []
+    constants = 0
+    for command in commands:
+        op = command[0]
+        if op == OP_PUSH and command[1] == CONSTANT:
+            out.append(push_constant(to_signed(command[2])))
+            constants += 1
+            continue
+
+        if op in BINARY_OPS and constants >= 2:
+            value = to_signed(BINARY_OPS[op](out[-2][2], out[-1][2]))
+            if value >= MIN_CONSTANT:
+                out[-2:] = [push_constant(value)]
+                constants -= 1
+                continue
+        elif op in IDENTITIES and constants and \
+                out[-1][2] == IDENTITIES[op]:
+            out.pop()
+            constants -= 1
+            continue
+        elif op in UNARY_OPS:
+            if constants:
+                value = to_signed(UNARY_OPS[op](out[-1][2]))
+                if value >= MIN_CONSTANT:
+                    out[-1] = push_constant(value)
+                    continue
+            elif out and out[-1][0] == op:  # neg neg, not not
+                out.pop()
+                continue
+            yield from out
+            out = [command]
+            constants = 0
+            continue
+        elif op == OP_IF and constants:
+            if out.pop()[2]:
+                out.append((OP_GOTO, command[1], 0))
+            constants -= 1
+            yield from out
+            out = []
+            constants = 0
+            continue
+
+        yield from out
+        yield command
+        out = []
+        constants = 0
+    yield from out
+
+
+def split_functions(commands):
+    """
+    Splits a stream of commands into functions, without resolving names as
+    functions does.
+    :param commands: iterable of (opcode, arg1, arg2) triplets
+    :return: generator of lists of the triplets of every function, starting
+    with its function command. Commands before the first function are
+    yielded first, as a list of their own.
+    """
+    body = []
+    for command in commands:
+        if command[0] == OP_FUNCTION and body:
+            yield body
+            body = []
+        body.append(command)
+    if body:
+        yield body
+
+
+class ControlFlowGraph:
+    """
+    The basic blocks of a function and the jumps between them. A block
+    starts at a label or after a jump and ends with a jump or before a
+    label, labels being local to their function.
+
+    """
+
+    def __init__(self, commands):
+        """
+        :param commands: list of the (opcode, arg1, arg2) triplets of a
+        function, as yielded by split_functions
+        """
+        # Lists of the triplets of every block, in order
+        self.blocks = []
+        block = []
+        for command in commands:
+            if command[0] == OP_LABEL and block:
+                self.blocks.append(block)
+                block = []
+            block.append(command)
+            if command[0] in ENDS_BLOCK:
+                self.blocks.append(block)
+                block = []
+        if block:
+            self.blocks.append(block)
+        # Label name id: index of the block it starts
+        self.labels = {block[0][1]: index
+                       for index, block in enumerate(self.blocks)
+                       if block[0][0] == OP_LABEL}
+
+    def successors(self, index):
+        """
+        :return: indices of the blocks control may pass to from a block
+        """
+        last = self.blocks[index][-1]
+        successors = []
+        if last[0] in (OP_GOTO, OP_IF) and last[1] in self.labels:
+            successors.append(self.labels[last[1]])
+        if last[0] not in (OP_GOTO, OP_RETURN) and \
+                index + 1 < len(self.blocks):
+            successors.append(index + 1)
+        return successors
+
+    def reachable(self):
+        """
+        :return: set of the indices of the blocks reachable from the first
+        """
+        reachable = set()
+        pending = [0] if self.blocks else []
+        while pending:
+            index = pending.pop()
+            if index not in reachable:
+                reachable.add(index)
+                pending.extend(self.successors(index))
+        return reachable
+
+    def target(self, label):
+        """
+        Follows a jump to a label through blocks that only pass control on:
+        labels followed by other labels, or by a goto.
+        :return: the name id of the label control ends up at
+        """
+        seen = set()
+        while label in self.labels and label not in seen:
+            seen.add(label)
+            index = self.labels[label]
+            block = self.blocks[index]
+            if len(block) == 1 and index + 1 < len(self.blocks):
+                label = self.blocks[index + 1][0][1]
+            elif len(block) == 2 and block[1][0] == OP_GOTO:
+                label = block[1][1]
+            else:
+                break
+        return label
+
+    def commands(self):
+        """
+        :return: list of the triplets of all the blocks, in order
+        """
+        return [command for block in self.blocks for command in block]
+
+
+def simplify_function(commands):
+    """
+    Simplifies the jumps of a function until nothing changes: jumps to a
+    goto go to its target directly, blocks that can't be reached are
+    removed, gotos to the label that follows them are dropped and so are
+    the labels nothing jumps to.
+    :param commands: list of the (opcode, arg1, arg2) triplets of a function
+    :return: list of the simplified triplets
+    """
+    while True:
+        graph = ControlFlowGraph(commands)
+        reachable = graph.reachable()
+        simplified = []
+        for index, block in enumerate(graph.blocks):
+            if index not in reachable:
+                continue
+            for op, arg1, arg2 in block:
+                if op in (OP_GOTO, OP_IF):
+                    arg1 = graph.target(arg1)
+                simplified.append((op, arg1, arg2))
+
+        # Gotos followed by their label, maybe after other labels
+        commands = []
+        for index in reversed(range(len(simplified))):
+            op, arg1, arg2 = simplified[index]
+            if op == OP_GOTO:
+                following = index + 1
+                while following < len(simplified) and \
+                        simplified[following][0] == OP_LABEL:
+                    if simplified[following][1] == arg1:
+                        break
+                    following += 1
+                else:
+                    following = None
+                if following is not None:
+                    continue
+            commands.append(simplified[index])
+        commands.reverse()
+
+        targets = {arg1 for op, arg1, arg2 in commands
+                   if op in (OP_GOTO, OP_IF)}
+        commands = [command for command in commands
+                    if command[0] != OP_LABEL or command[1] in targets]
+        if commands == graph.commands():
+            return commands
+
+
+def simplify_control_flow(commands):
+    """
+    Simplifies the control flow of every function, see simplify_function.
+    :param commands: iterable of (opcode, arg1, arg2) triplets
+    :return: generator of the simplified triplets
+    """
+    for function in split_functions(commands):
+        yield from simplify_function(function)
+
+
+def call_graph(programs, intrinsics=()):
+    """
+    :param programs: Programs of all the files of a program
+    :param intrinsics: (name, number of arguments) of the calls written
+    inline by the code writer, which don't call the function
+    :return: dict from every function name to the set of the functions it
+    calls. Calls made outside of any function are listed under None.
+    """
+    calls = {None: set()}
+    for program in programs:
+        names = program.names
+        callees = calls[None]
+        for op, arg1, arg2 in program.commands():
+            if op == OP_FUNCTION:
+                callees = calls.setdefault(names[arg1], set())
+            elif op == OP_CALL and (names[arg1], arg2) not in intrinsics:
+                callees.add(names[arg1])
+    return calls
+
+
+def reachable_functions(programs, roots=('Sys.init',), intrinsics=()):
+    """
+    :param programs: Programs of all the files of a program
+    :param roots: names of the functions the program starts from
+    :param intrinsics: calls written inline, see call_graph
+    :return: set of the names of the functions that may ever be called
+    """
+    calls = call_graph(programs, intrinsics)
+    reachable = set()
+    pending = list(roots) + list(calls[None])
+    while pending:
+        name = pending.pop()
+        if name not in reachable:
+            reachable.add(name)
+            pending.extend(calls.get(name, ()))
+    return reachable
+
+
+def eliminate_dead_functions(programs, roots=('Sys.init',), intrinsics=()):
+    """
+    Drops the bodies of the functions no call can reach from the roots.
+    Commands outside of any function are kept.
+    :param programs: Programs of all the files of a program
+    :param roots: names of the functions the program starts from
+    :param intrinsics: calls written inline, see call_graph
+    :return: (list of the pruned Programs, sorted names of the removed
+    functions)
+    """
+    dead = set(call_graph(programs, intrinsics)) - \
+        reachable_functions(programs, roots, intrinsics) - {None}
+    return remove_functions(programs, dead)
+
+
+def remove_functions(programs, dead):
+    """
+    Drops the bodies of the named functions.
+    :param programs: Programs of all the files of a program
+    :param dead: names of the functions to drop
+    :return: (list of the pruned Programs, sorted names of the removed
+    functions)
+    """
+    pruned = []
+    removed = []
+    for program in programs:
+        names = program.names
+        result = Program(names)
+        keep = True
+        for op, arg1, arg2 in program.commands():
+            if op == OP_FUNCTION:
+                keep = names[arg1] not in dead
+                if not keep:
+                    removed.append(names[arg1])
+            if keep:
+                result.append(op, arg1, arg2)
+        pruned.append(result)
+    return pruned, sorted(removed)
+
+
+def functions(program):
+    """
+    Splits a program into its functions.
+    :return: generator of (name, number of locals, body) of every function,
+    the body being a list of (opcode, name or None, arg2) triplets with the
+    names resolved, without the function command. Commands before the first
+    function are yielded first, as the body of a function named None.
+    """
+    names = program.names
+    name, num_locals, body = None, 0, []
+    for op, arg1, arg2 in program.commands():
+        if op == OP_FUNCTION:
+            if name is not None or body:
+                yield name, num_locals, body
+            name, num_locals, body = names[arg1], arg2, []
+        else:
+            body.append((op, names[arg1] if op >= OP_PUSH and
+                         op != OP_RETURN else None, arg2))
+    if name is not None or body:
+        yield name, num_locals, body
+
+
+def inlinable(body, num_locals, size):
+    """
+    Checks that a function can be inlined: it is no longer than size, makes
+    no calls, only uses locals it declared, and the depth of its stack is
+    known at every label and is exactly 1 at every return, so that the
+    returned value is left on the caller's stack as is.
+    :return: bool
+    """
+    if len(body) > size:
+        return False
+    depths = {}
+    depth = 0
+    for op, name, arg2 in body:
+        if depth is None and op != OP_LABEL:
+            continue  # unreachable
+        if op == OP_CALL:
+            return False
+        elif op in (OP_PUSH, OP_POP):
+            if name == 'local' and arg2 >= num_locals:
+                return False
+            depth += 1 if op == OP_PUSH else -1
+        elif op in BINARY_OPS:
+            depth -= 1
+        elif op == OP_LABEL:
+            if depth is None:
+                depth = depths.get(name)
+                if depth is None:
+                    return False
+            elif depths.setdefault(name, depth) != depth:
+                return False
+        elif op in (OP_GOTO, OP_IF):
+            if op == OP_IF:
+                depth -= 1
+            if depths.setdefault(name, depth) != depth:
+                return False
+            if op == OP_GOTO:
+                depth = None
+        elif op == OP_RETURN:
+            if depth != 1:
+                return False
+            depth = None
+        if depth is not None and depth < 0:
+            return False
+    return depth is None
+
+
+def read_locals(body):
+    """
+    :return: set of the locals a function body may read before writing
+    them, which must be zeroed as on a call. The others are known to be
+    written first, by a pop before any jump or label.
+    """
+    written = set()
+    read = set()
+    straight = True
+    for op, name, arg2 in body:
+        if op in (OP_LABEL, OP_GOTO, OP_IF, OP_RETURN):
+            straight = False
+        elif name == 'local' and arg2 not in written:
+            if op == OP_POP and straight:
+                written.add(arg2)
+            elif op == OP_PUSH:
+                read.add(arg2)
+    return read
+
+
+def saved_pointers(body):
+    """
+    :return: sorted indices of the pointers a function body changes, which
+    return would restore
+    """
+    return sorted({arg2 for op, name, arg2 in body
+                   if op == OP_POP and name == 'pointer'})
+
+
+def inline_overhead(body, num_args):
+    """
+    :return: number of the commands inline_body adds around the body
+    """
+    return (4 * len(saved_pointers(body)) + num_args +
+            2 * len(read_locals(body)))
+
+
+def inline_body(callee, num_args, num_locals, body, base, site, intern):
+    """
+    Renders the inlined body of a call. The arguments are popped from the
+    stack into the caller's locals from base on, followed by the callee's
+    locals and the saved THIS/THAT of the caller if the callee changes them.
+    :param site: number of the call site, keeps its labels unique
+    :param intern: the caller's NameTable.intern
+    :return: (list of (opcode, arg1, arg2) triplets for the caller, number
+    of the caller's locals used)
+    """
+    local = SEGMENTS.index('local')
+    pointer = SEGMENTS.index('pointer')
+    saved = saved_pointers(body)
+    slots = base + num_args + num_locals
+
+    commands = []
+    for i, index in enumerate(saved):
+        commands += [(OP_PUSH, pointer, index), (OP_POP, local, slots + i)]
+    commands += [(OP_POP, local, base + i) for i in reversed(range(num_args))]
+    for i in sorted(read_locals(body)):
+        commands += [(OP_PUSH, CONSTANT, 0),
+                     (OP_POP, local, base + num_args + i)]
+
+    end = intern('%s$%d' % (callee, site))
+    ends = False
+    for index, (op, name, arg2) in enumerate(body):
+        if op in (OP_PUSH, OP_POP):
+            if name == 'argument':
+                commands.append((op, local, base + arg2))
+            elif name == 'local':
+                commands.append((op, local, base + num_args + arg2))
+            else:
+                commands.append((op, intern(name), arg2))
+        elif op in (OP_LABEL, OP_GOTO, OP_IF):
+            commands.append((op, intern('%s$%d$%s' % (callee, site, name)),
+                             0))
+        elif op == OP_RETURN:
+            if index < len(body) - 1:
+                commands.append((OP_GOTO, end, 0))
+                ends = True
+        elif op in BINARY_OPS or op in UNARY_OPS:
+            commands.append((op, 0, 0))
+        else:
+            raise ValueError("Can't inline the %s command of %s"
+                             % (COMMAND_TYPES[op].value, callee))
+    if ends:
+        commands.append((OP_LABEL, end, 0))
+
+    for i, index in enumerate(saved):
+        commands += [(OP_PUSH, local, slots + i), (OP_POP, pointer, index)]
+    return commands, slots + len(saved) - base
+
+
+def inline_functions(programs, size=INLINE_SIZE, intrinsics=()):
+    """
+    Inlines the calls of small leaf functions: functions of at most size
+    commands that make no calls, when this doesn't take more than
+    INLINE_OVERHEAD commands around the body. A function using static variables is only
+    inlined into functions of the same file, since statics are named after
+    the file. Callees left without calls are not removed here, see
+    remove_functions.
+    :param programs: Programs of all the files of a program
+    :param size: largest number of commands of an inlined function
+    :param intrinsics: calls written inline by the code writer, see
+    call_graph, which are kept
+    :return: (list of the new Programs, number of calls inlined, set of the
+    names of the functions whose every call was inlined)
+    """
+    leaves = {}
+    for program in programs:
+        for name, num_locals, body in functions(program):
+            if inlinable(body, num_locals, size):
+                statics = any(op in (OP_PUSH, OP_POP) and segment == 'static'
+                              for op, segment, arg2 in body)
+                leaves[name] = (program, num_locals, body, statics)
+
+    result = []
+    sites = 0
+    inlined = set()
+    called = set()
+    for program in programs:
+        names = program.names
+        new = Program(names)
+        for name, num_locals, body in functions(program):
+            commands = []
+            extra = 0
+            for op, arg1, arg2 in body:
+                leaf = leaves.get(arg1) if op == OP_CALL and \
+                    name is not None and \
+                    (arg1, arg2) not in intrinsics else None
+                if leaf is not None and leaf[0] is not program and leaf[3]:
+                    leaf = None
+                if leaf is not None and (any(
+                        op2 in (OP_PUSH, OP_POP) and segment == 'argument' and
+                        index >= arg2 for op2, segment, index in leaf[2]) or
+                        inline_overhead(leaf[2], arg2) > INLINE_OVERHEAD):
+                    leaf = None  # costly, or reads missing arguments
+                if leaf is None:
+                    if op == OP_CALL:
+                        called.add(arg1)
+                    commands.append((op, names.intern(arg1)
+                                     if arg1 is not None else 0, arg2))
+                    continue
+                callee_program, callee_locals, callee_body, _ = leaf
+                code, slots = inline_body(arg1, arg2, callee_locals,
+                                          callee_body, num_locals, sites,
+                                          names.intern)
+                extra = max(extra, slots)
+                commands += code
+                inlined.add(arg1)
+                sites += 1
+            if name is not None:
+                new.append(OP_FUNCTION, names.intern(name),
+                           num_locals + extra)
+            for command in commands:
+                new.append(*command)
+        result.append(new)
+    return result, sites, inlined - called
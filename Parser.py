@@ -5,9 +5,9 @@ Parses from VM language to .asm code
 Author: Shimon Heimowitz
 
 """
+from array import array
 from enum import Enum, unique
 
-
 class Command(Enum):
     """
     Enumerator holding values for various vm command types
@@ -43,65 +43,201 @@ class Arithmetic(Enum):
     NOT = "not"
 
 
+# Integer opcodes of the intermediate representation. Arithmetic opcodes come
+# first and follow the order of the Arithmetic enum.
+(OP_ADD, OP_SUB, OP_NEG, OP_EQ, OP_GT, OP_LT, OP_AND, OP_OR, OP_NOT,
+ OP_PUSH, OP_POP, OP_LABEL, OP_GOTO, OP_IF, OP_FUNCTION, OP_RETURN,
+ OP_CALL) = range(17)
+
+ARITHMETIC_OPS = tuple(operand.value for operand in Arithmetic)
+
+# Maps the first word of a vm line to its opcode
+OPCODES = dict(zip(ARITHMETIC_OPS, range(len(ARITHMETIC_OPS))))
+OPCODES.update({Command.C_PUSH.value: OP_PUSH,
+                Command.C_POP.value: OP_POP,
+                Command.C_LABEL.value: OP_LABEL,
+                Command.C_GOTO.value: OP_GOTO,
+                Command.C_IF.value: OP_IF,
+                Command.C_FUNCTION.value: OP_FUNCTION,
+                Command.C_RETURN.value: OP_RETURN,
+                Command.C_CALL.value: OP_CALL})
+
+# Maps an opcode back to its command type
+COMMAND_TYPES = ((Command.C_ARITHMETIC,) * len(ARITHMETIC_OPS) +
+                 (Command.C_PUSH, Command.C_POP, Command.C_LABEL,
+                  Command.C_GOTO, Command.C_IF, Command.C_FUNCTION,
+                  Command.C_RETURN, Command.C_CALL))
+
+# Segments are interned first, so a segment's name id is its index here
+SEGMENTS = ('constant', 'local', 'argument', 'this', 'that', 'temp',
+            'static', 'pointer')
+
+
+class NameTable:
+    """
+    Interns the segment, label and function names of a program, so that
+    commands refer to names by a small integer id.
+
+    """
+
+    def __init__(self):
+        self.names = []
+        self.ids = {}
+        for segment in SEGMENTS:
+            self.intern(segment)
+
+    def intern(self, name):
+        """
+        Returns the id of the given name, adding it to the table if needed.
+        :param name: string
+        :return: int
+        """
+        name_id = self.ids.get(name)
+        if name_id is None:
+            name_id = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+    def __getitem__(self, name_id):
+        return self.names[name_id]
+
+    def __len__(self):
+        return len(self.names)
+
+
+class Program:
+    """
+    Compact intermediate representation of parsed vm commands.
+    Command i is held column wise: its opcode in ops[i], its first argument
+    (a name id, or 0 if unused) in arg1[i], and its numeric second argument
+    (or 0 if unused) in arg2[i].
+
+    """
+
+    def __init__(self, names=None):
+        self.names = NameTable() if names is None else names
+        self.ops = array('B')
+        self.arg1 = array('i')
+        self.arg2 = array('i')
+
+    def append(self, op, arg1=0, arg2=0):
+        """
+        Appends a single command to the program.
+        """
+        self.ops.append(op)
+        self.arg1.append(arg1)
+        self.arg2.append(arg2)
+
+    def commands(self):
+        """
+        :return: iterator of (opcode, arg1, arg2) triplets
+        """
+        return zip(self.ops, self.arg1, self.arg2)
+
+    def __len__(self):
+        return len(self.ops)
+
+
 class Parser:
     """
     Parser class.  Parse one file at a time.
+    The file is tokenized once into a Program, the commands are then read
+    back from it.
 
     """
 
-    EMPTY_LINE = ""
     COMMENT = "//"
-    NEW_LINE = "\n"
-    SPACE = " "
+    STREAM_BUFFER = 1 << 20
 
     C_TYPE = 0
     FIRST_ARG = 1
     SECOND_ARG = 2
 
-    def __init__(self, file):
+    def __init__(self, file, names=None):
         """
         Opens the input file/stream and gets ready to parse it.
-        :param input_file:
+        :param file: path of the vm file
+        :param names: NameTable to intern names into, a new one if None
         """
         with open(file) as fp:
-            self.lines = [line.rstrip(self.NEW_LINE) for line in fp]
+            self.program = self.parse(fp, names)
+        self.len = len(self.program)
 
-        self.clean_lines()
-        self.len = self.lines.__len__()
-
-        # Initialize an iterator of the list
-        self.lines_iter = iter(self.lines)
+        self.index = -1
+        self.op = None
         self.first_arg = None
         self.second_arg = None
         self.type = Command.UNKNOWN
 
-    def clean_lines(self):
+    @classmethod
+    def parse(cls, lines, names=None):
+        """
+        Tokenizes vm lines into a Program.
+        :param lines: iterable of vm lines
+        :param names: NameTable to intern names into, a new one if None
+        :return: Program
+        """
+        program = Program(names)
+        ops_append = program.ops.append
+        arg1_append = program.arg1.append
+        arg2_append = program.arg2.append
+        for op, arg1, arg2 in cls.tokenize(lines, program.names):
+            ops_append(op)
+            arg1_append(arg1)
+            arg2_append(arg2)
+        return program
+
+    @classmethod
+    def stream(cls, file, names):
+        """
+        Lazily tokenizes a vm file read through a fixed size buffer, so that
+        only the current chunk is ever held in memory.
+        :param file: path of the vm file
+        :param names: NameTable to intern names into
+        :return: generator of (opcode, arg1, arg2) triplets
+        """
+        with open(file, buffering=cls.STREAM_BUFFER) as fp:
+            yield from cls.tokenize(fp, names)
+
+    @classmethod
+    def tokenize(cls, lines, names):
         """
-        Cleans all irrelevant comments and empty lines from the list of lines.
-        Lines will only hold real command lines after cleaning.
+        Tokenizes vm lines one at a time. Comments, empty lines and unknown
+        commands are dropped.
+        :param lines: iterable of vm lines
+        :param names: NameTable to intern names into
+        :return: generator of (opcode, arg1, arg2) triplets
         """
-        for i in range(self.lines.__len__()):
-            # remove white space
-            # self.lines[i] = self.lines[i].replace(" ", "")
+        intern = names.intern
+        opcodes = OPCODES
+        comment = cls.COMMENT
 
-            # convert all comment sections into empty strings
-            comment_index = self.lines[i].find(self.COMMENT)
+        for line in lines:
+            comment_index = line.find(comment)
             if comment_index >= 0:  # comment found inline or whole line
-                self.lines[i] = self.lines[i][:comment_index]
-
-        # remove all empty lines
-        self.lines = [line for line in self.lines if line != self.EMPTY_LINE]
+                line = line[:comment_index]
+            args = line.split()
+            if not args:
+                continue
+            op = opcodes.get(args[cls.C_TYPE])
+            if op is None:
+                continue
+
+            if op < OP_PUSH or op == OP_RETURN:
+                yield op, 0, 0
+            elif op in (OP_LABEL, OP_GOTO, OP_IF):
+                yield op, intern(args[cls.FIRST_ARG]), 0
+            else:
+                yield (op, intern(args[cls.FIRST_ARG]),
+                       int(args[cls.SECOND_ARG]))
 
     def hasMoreCommands(self):
         """
         Are there more commands in the input?
         :return: boolean value, True iff there are more commands
         """
-        try:
-            self.cur = next(self.lines_iter)
-        except StopIteration:
-            return False
-        return True
+        self.index += 1
+        return self.index < self.len
 
     def advance(self):
         """
@@ -120,64 +256,17 @@ class Parser:
         C_ARITHMETIC, C_PUSH, C_POP, C_LABEL, C_GOTO, C_IF, C_FUNCTION,
         C_RETURN, C_CALL
         """
-        args = self.cur.split(self.SPACE)
-
-        if args[self.C_TYPE] == Command.C_PUSH.value:
-            self.type = Command.C_PUSH
-            self.first_arg = args[self.FIRST_ARG]
-            self.second_arg = args[self.SECOND_ARG]
-            return Command.C_PUSH
-
-        if args[self.C_TYPE] == Command.C_POP.value:
-            self.type = Command.C_POP
-            self.first_arg = args[self.FIRST_ARG]
-            self.second_arg = args[self.SECOND_ARG]
-            return Command.C_POP
-
-        if args[self.C_TYPE] == Command.C_RETURN.value:
-            self.type = Command.C_RETURN
+        program = self.program
+        self.op = op = program.ops[self.index]
+        self.type = COMMAND_TYPES[op]
+        if op < OP_PUSH:
+            self.first_arg = ARITHMETIC_OPS[op]
+        elif op == OP_RETURN:
             self.first_arg = None
-            self.second_arg = None
-            return Command.C_RETURN
-
-        if args[self.C_TYPE] == Command.C_GOTO.value:
-            self.type = Command.C_GOTO
-            self.first_arg = args[self.FIRST_ARG]
-            self.second_arg = None
-            return Command.C_GOTO
-
-        if args[self.C_TYPE] == Command.C_IF.value:
-            self.type = Command.C_IF
-            self.first_arg = args[self.FIRST_ARG]
-            self.second_arg = None
-            return Command.C_IF
-
-        if args[self.C_TYPE] == Command.C_LABEL.value:
-            self.type = Command.C_LABEL
-            self.first_arg = args[self.FIRST_ARG]
-            self.second_arg = None
-            return Command.C_LABEL
-
-        if args[self.C_TYPE] == Command.C_FUNCTION.value:
-            self.type = Command.C_FUNCTION
-            self.first_arg = args[self.FIRST_ARG]
-            self.second_arg = args[self.SECOND_ARG]
-            return Command.C_FUNCTION
-
-        if args[self.C_TYPE] == Command.C_CALL.value:
-            self.type = Command.C_CALL
-            self.first_arg = args[self.FIRST_ARG]
-            self.second_arg = args[self.SECOND_ARG]
-            return Command.C_CALL
-
-        for operand in Arithmetic:
-            if self.cur.startswith(operand.value):
-                self.type = Command.C_ARITHMETIC
-                self.first_arg = operand.value
-                return Command.C_ARITHMETIC
-
-        self.type = Command.UNKNOWN
-        return Command.UNKNOWN
+        else:
+            self.first_arg = program.names[program.arg1[self.index]]
+        self.second_arg = program.arg2[self.index]
+        return self.type
 
     def arg1(self):
         """
@@ -189,12 +278,8 @@ class Parser:
         """
         assert self.type != Command.C_RETURN
 
-        # if self.type == Command.C_ARITHMETIC or self.type == Command.C_PUSH \
-        #         or self.type == Command.C_POP:
         return self.first_arg
 
-        # return Command.UNKNOWN.name
-
     def arg2(self):
         """
         Returns the second argument of the current
@@ -206,7 +291,7 @@ class Parser:
         assert self.type == Command.C_FUNCTION or self.type == Command.C_PUSH \
                or self.type == Command.C_POP or self.type == Command.C_CALL
 
-        return int(self.second_arg)
+        return self.second_arg
 
 
 if __name__ == "__main__":
@@ -0,0 +1,101 @@
+"""
+Peephole optimizer for Nand to Tetris project7, HUJI
+
+Rewrites the assembly code written by CodeWriter before it reaches the
+output, replacing short redundant instruction sequences with cheaper
+equivalent ones. Every rule is a regular expression over whole lines, so
+a rule never matches across a label unless it names the label itself.
+
+"""
+
+import re
+
+# name: (pattern, replacement), in the order they are tried
+RULES = {
+    # @SP, M=M-1, A=M: decrement and load the address in one instruction
+    'decrement-load': (r'^@SP\nM=M-1\nA=M\n',
+                       '@SP\nAM=M-1\n'),
+    # A second @SP to address the slot below the one just popped
+    'reuse-sp': (r'^@SP\nAM=M-1\nD=M\n@SP\nA=M-1\n',
+                 '@SP\nAM=M-1\nD=M\nA=A-1\n'),
+    # A push of D immediately popped back into D, the stack is unchanged
+    # and the next instruction loads A anyway
+    'push-pop': (r'^@SP\nA=M\nM=D\n@SP\nM=M\+1\n@SP\nAM=M-1\nD=M\n(?=@)',
+                 ''),
+    # The true of comparisons, -1 is a constant of the ALU
+    'true-constant': (r'^M=1\nM=-M\n',
+                      'M=-1\n'),
+    # Reading back a value just stored from D
+    'store-load': (r'^@(\S+)\nM=D\n@\1\nD=M\n',
+                   r'@\1\nM=D\n'),
+    # A jump to the label right after it
+    'jump-to-next': (r'^@(\S+)\n0;JMP\n\(\1\)\n',
+                     r'(\1)\n'),
+    # A value of A that is never used, since A is loaded again right away
+    'dead-a-load': (r'^@\S+\n(?=@)',
+                    ''),
+    # A value of D overwritten by the next computation, which doesn't use D
+    'dead-d': (r'^D=[^;\n]*\n(@\S+\n)(?=D=[^D;\n]*\n)',
+               r'\1'),
+}
+
+# Lines kept back between calls, so that rules can match sequences split
+# between two of them: the lines of the longest rule, and one more for a
+# lookahead past it. Counting every \n of the patterns errs on the long side.
+HOLD_LINES = max(pattern.count(r'\n') for pattern, _ in RULES.values()) + 1
+
+# Passes over a chunk at most, a rule may expose matches of others
+MAX_PASSES = 4
+
+
+class Peephole:
+    """
+    Applies a set of RULES to the assembly code fed to it in chunks, counting
+    the rewrites of every rule.
+
+    """
+
+    def __init__(self, rules=None):
+        """
+        :param rules: names of the rules to apply, all of them if None
+        """
+        if rules is None:
+            rules = RULES
+        unknown = set(rules) - set(RULES)
+        if unknown:
+            raise ValueError("Unknown peephole rules: %s"
+                             % ", ".join(sorted(unknown)))
+        self.rules = [(name, re.compile(RULES[name][0], re.MULTILINE),
+                       RULES[name][1]) for name in RULES if name in rules]
+        self.counts = dict.fromkeys((name for name, _, _ in self.rules), 0)
+        self.pending = ''
+
+    def optimize(self, asm, final=True):
+        """
+        Optimizes a chunk of assembly code.
+        :param asm: string of complete lines
+        :param final: if False, the last lines are kept back to be optimized
+        along with the next chunk.
+        :return: the optimized assembly code ready to be written
+        """
+        asm = self.pending + asm
+        for _ in range(MAX_PASSES):
+            changed = False
+            for name, pattern, replacement in self.rules:
+                asm, count = pattern.subn(replacement, asm)
+                if count:
+                    self.counts[name] += count
+                    changed = True
+            if not changed:
+                break
+
+        if final:
+            self.pending = ''
+            return asm
+        cut = len(asm)
+        for _ in range(HOLD_LINES):
+            cut = asm.rfind('\n', 0, cut - 1) + 1
+            if cut <= 0:
+                break
+        self.pending = asm[cut:]
+        return asm[:cut]
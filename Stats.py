@@ -0,0 +1,205 @@
+"""
+Translation statistics for Nand to Tetris project7, HUJI
+
+Counts the vm commands of every type, and measures the time spent parsing
+and in every CodeWriter.write* method, along with the number of Hack
+instructions each of them emitted (before peephole optimization, whose
+rewrites are counted per rule). Commands are counted as parsed, including
+those constant folding drops, and the time and instructions of a
+superinstruction are shared between the commands it writes.
+
+"""
+
+import json
+import time
+from Parser import ARITHMETIC_OPS, COMMAND_TYPES, OP_PUSH
+
+# Methods of the writer that are timed
+WRITER_METHODS = ('writeInit', 'writeArithmetic', 'writePushPop',
+                  'writeLabel', 'writeGoto', 'writeIf', 'writeFunction',
+                  'writeReturn', 'writeCall', 'writeFragment', 'writeFused',
+                  'close')
+
+
+def count_instructions(asm):
+    """
+    :param asm: assembly code string
+    :return: the number of instructions in it, labels excluded
+    """
+    return asm.count('\n') - asm.count('(')
+
+
+def new_entry():
+    return {'count': 0, 'time': 0.0, 'instructions': 0}
+
+
+class Stats:
+    """
+    Statistics of a translation, gathered from an instrumented CodeWriter.
+    Time and instructions of nested write* calls (such as the pushes of
+    writeCall) are only counted for the outermost method.
+
+    """
+
+    def __init__(self):
+        self.parse_time = 0.0
+        self.commands = {}
+        self.arithmetic = {}
+        self.methods = {}
+        self.instructions = 0
+        self.depth = 0
+        self.peephole = None
+
+    def timed_parse(self, parse, *args):
+        """
+        Calls a parsing function, adding its run time to the parse time.
+        :return: whatever parse returned
+        """
+        start = time.perf_counter()
+        result = parse(*args)
+        self.parse_time += time.perf_counter() - start
+        return result
+
+    def timed_stream(self, commands):
+        """
+        Wraps a lazily parsed stream of commands, adding the time spent
+        producing every command to the parse time.
+        :param commands: iterator of (opcode, arg1, arg2) triplets
+        :return: generator of the same triplets
+        """
+        commands = iter(commands)
+        while True:
+            start = time.perf_counter()
+            command = next(commands, None)
+            self.parse_time += time.perf_counter() - start
+            if command is None:
+                return
+            yield command
+
+    def instrument(self, writer):
+        """
+        Replaces the writer's dispatch table, write* methods and emitter with
+        measuring wrappers. Called by the writer before anything is written.
+        :param writer: CodeWriter
+        """
+        emit = writer._emit
+
+        def counting_emit(asm):
+            self.instructions += count_instructions(asm)
+            emit(asm)
+
+        writer._emit = counting_emit
+        self.peephole = writer.peephole
+        for name in WRITER_METHODS:
+            setattr(writer, name, self.measured_method(
+                getattr(writer, name), self.methods.setdefault(name, {
+                    'calls': 0, 'time': 0.0, 'instructions': 0})))
+
+        dispatch = []
+        for op, handler in enumerate(writer.dispatch):
+            for entry in self.entries(op):
+                handler = self.measured(handler, entry)
+            dispatch.append(handler)
+        writer.dispatch = tuple(dispatch)
+
+        write_commands = writer.writeCommands
+        writer.writeCommands = lambda commands, names: write_commands(
+            self.counted(commands), names)
+        writer.writeFused = self.measured_fusion(writer.writeFused)
+
+    def entries(self, op):
+        """
+        :return: the entries of the statistics of a command with this
+        opcode: of its type, and of its arithmetic op
+        """
+        entries = [self.commands.setdefault(COMMAND_TYPES[op].name,
+                                            new_entry())]
+        if op < OP_PUSH:
+            entries.append(self.arithmetic.setdefault(ARITHMETIC_OPS[op],
+                                                      new_entry()))
+        return entries
+
+    def counted(self, commands):
+        """
+        Wraps a stream of commands, counting them before the writer
+        optimizes them.
+        :param commands: iterable of (opcode, arg1, arg2) triplets
+        :return: generator of the same triplets
+        """
+        for command in commands:
+            for entry in self.entries(command[0]):
+                entry['count'] += 1
+            yield command
+
+    def measured(self, function, entry):
+        """
+        Wraps a function to add its run time and emitted instructions to an
+        entry of the statistics.
+        """
+        def wrapper(*args):
+            instructions = self.instructions
+            start = time.perf_counter()
+            try:
+                return function(*args)
+            finally:
+                entry['time'] += time.perf_counter() - start
+                entry['instructions'] += self.instructions - instructions
+        return wrapper
+
+    def measured_fusion(self, write_fused):
+        """
+        Wraps CodeWriter.writeFused to share the run time and emitted
+        instructions of every superinstruction evenly between the entries
+        of the commands it wrote.
+        """
+        def wrapper(window, names):
+            instructions = self.instructions
+            start = time.perf_counter()
+            fused = write_fused(window, names)
+            if fused:
+                elapsed = time.perf_counter() - start
+                emitted = self.instructions - instructions
+                for i, command in enumerate(window[:fused]):
+                    for entry in self.entries(command[0]):
+                        entry['time'] += elapsed / fused
+                        entry['instructions'] += emitted // fused + \
+                            (i < emitted % fused)
+            return fused
+        return wrapper
+
+    def measured_method(self, method, entry):
+        """
+        Like measured, but only calls that are not nested in another measured
+        method are added to the entry.
+        """
+        def wrapper(*args):
+            if self.depth:
+                return method(*args)
+            self.depth += 1
+            instructions = self.instructions
+            start = time.perf_counter()
+            try:
+                return method(*args)
+            finally:
+                self.depth -= 1
+                entry['time'] += time.perf_counter() - start
+                entry['instructions'] += self.instructions - instructions
+                entry['calls'] += 1
+        return wrapper
+
+    def to_dict(self):
+        return {'parse_time': self.parse_time,
+                'commands': self.commands,
+                'arithmetic': self.arithmetic,
+                'methods': {name: entry for name, entry in self.methods.items()
+                            if entry['calls']},
+                'instructions': self.instructions,
+                'peephole': self.peephole.counts if self.peephole else {}}
+
+    def dump(self, fp):
+        """
+        Writes the statistics as JSON.
+        :param fp: writable file object
+        """
+        json.dump(self.to_dict(), fp, indent=2, sort_keys=True)
+        fp.write('\n')
@@ -0,0 +1,272 @@
+"""
+A small vm program covering every kind of command, and helpers translating
+it with Main and running it on the Emulator, for the tests
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Main
+from Emulator import Emulator
+
+MAX_CYCLES = 1000000
+
+SYS = """
+function Sys.init 0
+call Main.main 0
+pop temp 0
+label HALT
+goto HALT
+"""
+
+MAIN = """
+function Main.main 2
+// comparisons, the first two overflow
+push constant 32767
+push constant 2
+neg
+gt
+pop static 0
+push constant 32767
+push constant 2
+neg
+lt
+pop static 1
+push constant 7
+push constant 7
+eq
+pop static 2
+push constant 100
+push constant 58
+sub
+push constant 3
+add
+neg
+not
+pop static 3
+push constant 12
+push constant 10
+and
+push constant 1
+or
+pop static 4
+// leaf functions
+push constant 3
+push constant 4
+call Main.add 2
+pop local 0
+push local 0
+call Main.double 1
+pop static 5
+// sum of 1..10
+push constant 0
+pop local 1
+push constant 10
+pop local 0
+label LOOP
+push local 0
+push constant 0
+gt
+not
+if-goto DONE
+push local 1
+push local 0
+add
+pop local 1
+push local 0
+push constant 1
+sub
+pop local 0
+goto LOOP
+push constant 999
+pop local 1
+label DONE
+push local 1
+pop static 6
+push constant 123
+push constant 45
+call Math.multiply 2
+pop static 7
+push constant 1000
+push constant 7
+call Math.divide 2
+pop static 8
+// this and that
+push constant 3000
+pop pointer 0
+push constant 3010
+pop pointer 1
+push constant 5
+pop this 0
+push constant 6
+pop this 1
+push this 0
+push this 1
+add
+pop that 2
+push that 2
+pop static 9
+// tail calls
+push constant 10
+push constant 0
+call Main.count 2
+pop static 10
+push constant 0
+return
+
+function Main.add 0
+push argument 0
+push argument 1
+add
+return
+
+function Main.double 0
+push argument 0
+push argument 0
+add
+return
+
+function Main.count 0
+push argument 0
+push constant 0
+eq
+if-goto END
+push argument 0
+push constant 1
+sub
+push argument 1
+push argument 0
+add
+call Main.count 2
+return
+label END
+push argument 1
+return
+
+function Main.unused 0
+push constant 1
+return
+"""
+
+MATH = """
+// x * y for y >= 0, by repeated addition
+function Math.multiply 1
+push constant 0
+pop local 0
+label LOOP
+push argument 1
+push constant 0
+eq
+if-goto END
+push local 0
+push argument 0
+add
+pop local 0
+push argument 1
+push constant 1
+sub
+pop argument 1
+goto LOOP
+label END
+push local 0
+return
+
+// x / y for x >= 0 and y > 0, by repeated subtraction
+function Math.divide 1
+push constant 0
+pop local 0
+label LOOP
+push argument 0
+push argument 1
+lt
+if-goto END
+push argument 0
+push argument 1
+sub
+pop argument 0
+push local 0
+push constant 1
+add
+pop local 0
+goto LOOP
+label END
+push local 0
+return
+"""
+
+PROGRAM = {'Sys': SYS, 'Main': MAIN, 'Math': MATH}
+
+# Values of the statics of Main when the program ends
+EXPECTED = [0, -1, -1, 44, 9, 14, 55, 5535, 142, 11, 55]
+
+
+def write_program(directory, files=PROGRAM):
+    """
+    Writes the vm files of a program into a directory, created if needed.
+    :param directory: pathlib.Path
+    :param files: dict from file name, without .vm, to its vm code
+    :return: directory
+    """
+    directory.mkdir(exist_ok=True)
+    for name, code in files.items():
+        (directory / (name + Main.FILE_EXTENSION_VM)).write_text(code)
+    return directory
+
+
+def output_path(path, hack=False):
+    """
+    :return: path of the file Main writes for the program at path
+    """
+    path = str(path)
+    base = path[:-len(Main.FILE_EXTENSION_VM)] if os.path.isfile(path) \
+        else os.path.join(path, os.path.basename(path))
+    return base + (Main.FILE_EXTENSION_HACK if hack else
+                   Main.FILE_EXTENSION_ASM)
+
+
+def translate(path, **options):
+    """
+    Translates a program with Main.main.
+    :param options: keyword arguments of Main.main
+    :return: the content of the written file
+    """
+    assert Main.main(str(path), **options)
+    with open(output_path(path, options.get('hack', False))) as fp:
+        return fp.read()
+
+
+def emulate(path, **options):
+    """
+    Translates a program and runs it on the Emulator until it halts.
+    :param options: keyword arguments of Main.main
+    :return: Emulator
+    """
+    emulator = Emulator.from_asm(translate(path, **options).splitlines())
+    emulator.run(MAX_CYCLES)
+    return emulator
+
+
+def results(machine, count=len(EXPECTED)):
+    """
+    :param machine: Emulator or Interpreter that ran the program
+    :return: list of the values of the statics of Main
+    """
+    return [machine.value(machine.symbols['Main.%d' % i])
+            for i in range(count)]
+
+
+def check_optimizations(directory, *optimizations):
+    """
+    Checks that the program computes the same with the given optimizations
+    as without them.
+    :return: (Emulator of the plain translation, Emulator of the optimized
+    one)
+    """
+    write_program(directory)
+    plain = emulate(directory)
+    optimized = emulate(directory, optimizations=optimizations)
+    assert results(plain) == EXPECTED
+    assert results(optimized) == EXPECTED
+    return plain, optimized
@@ -0,0 +1,48 @@
+"""
+Tests of the assembler, run with pytest from the repository root
+"""
+
+from programs import EXPECTED, MAX_CYCLES, results, translate, \
+    write_program
+
+from Assembler import AssemblyError, assemble, to_hack
+from CodeWriter import GOALS
+from Emulator import Emulator
+
+
+def test_encodings():
+    words, symbols = assemble(['@2', 'D=A', '@i', 'M=D', '(LOOP)',
+                               'AM=M-1', '@LOOP', 'D;JGT', '@j', '0;JMP'])
+    assert to_hack(words).split() == ['0000000000000010',
+                                      '1110110000010000',
+                                      '0000000000010000',
+                                      '1110001100001000',
+                                      '1111110010101000',
+                                      '0000000000000100',
+                                      '1110001100000001',
+                                      '0000000000010001',
+                                      '1110101010000111']
+    assert symbols['LOOP'] == 4 and symbols['i'] == 16 and symbols['j'] == 17
+
+
+def test_invalid_instruction():
+    try:
+        assemble(['D=D*A'])
+    except AssemblyError:
+        return
+    assert False, "expected AssemblyError"
+
+
+def test_hack_same_as_assembled_asm(tmp_path):
+    program = write_program(tmp_path / 'Program')
+    for optimizations in ((), GOALS['size']):
+        asm = translate(program, optimizations=optimizations).splitlines()
+        hack = translate(program, hack=True, optimizations=optimizations)
+        assert hack == to_hack(assemble(asm)[0])
+
+        from_asm = Emulator.from_asm(asm)
+        from_asm.run(MAX_CYCLES)
+        from_hack = Emulator.from_hack(hack.splitlines())
+        from_hack.run(MAX_CYCLES)
+        assert results(from_asm) == EXPECTED
+        assert from_hack.ram == from_asm.ram
@@ -0,0 +1,134 @@
+"""
+Tests of the code generation strategies of the CodeWriter, run with pytest
+from the repository root. The test program is translated with and without
+each of them and run on the Emulator.
+"""
+
+from programs import check_optimizations, emulate, translate, \
+    write_program
+
+from CodeWriter import GOALS, SHARED_COMPARE, TOS_CACHE, INLINE, \
+    SUPERINSTRUCTIONS, COMPARE_BRANCH, TAIL_CALLS, INTRINSICS, CONTROL_FLOW, \
+    ADDRESSING, BASE_REUSE
+
+
+def rom_size(directory, *optimizations):
+    return sum(1 for line in translate(directory,
+                                       optimizations=optimizations).split()
+               if not line.startswith('('))
+
+
+def test_shared_compare(tmp_path):
+    check_optimizations(tmp_path, SHARED_COMPARE)
+
+
+def test_shared_compare_with_cached_top_of_stack(tmp_path):
+    check_optimizations(tmp_path, SHARED_COMPARE, TOS_CACHE)
+    write_program(tmp_path, {'Main': "function Main.main 0\n" +
+                             "push local 0\npush local 1\ngt\n" * 20 +
+                             "return\n"})
+    assert rom_size(tmp_path, SHARED_COMPARE, TOS_CACHE) < \
+        rom_size(tmp_path, TOS_CACHE)
+    assert SHARED_COMPARE in GOALS['size']
+
+
+def test_inline(tmp_path):
+    plain, inlined = check_optimizations(tmp_path, INLINE)
+    assert inlined.cycles < plain.cycles
+    asm = translate(tmp_path, optimizations=(INLINE,))
+    # Every call of Main.add was inlined, Main.unused is kept without
+    # dead-functions
+    assert '(Main.add)' not in asm
+    assert '(Main.unused)' in asm
+
+
+def test_tos_cache(tmp_path):
+    plain, cached = check_optimizations(tmp_path, TOS_CACHE)
+    assert cached.cycles < plain.cycles
+
+
+def test_superinstructions(tmp_path):
+    plain, fused = check_optimizations(tmp_path, SUPERINSTRUCTIONS)
+    assert fused.cycles < plain.cycles
+    assert rom_size(tmp_path, SUPERINSTRUCTIONS) < rom_size(tmp_path)
+
+
+def test_compare_branch(tmp_path):
+    plain, fused = check_optimizations(tmp_path, COMPARE_BRANCH)
+    assert fused.cycles < plain.cycles
+    # The gt, not, if-goto of the loop jumps without a boolean
+    asm = translate(tmp_path, optimizations=(COMPARE_BRANCH,))
+    assert asm.count('@FALSE') < translate(tmp_path).count('@FALSE')
+
+
+def stack_top(emulator):
+    """
+    :return: the highest stack address the program wrote
+    """
+    return max(address for address in range(256, 2048)
+               if emulator.ram[address])
+
+
+def test_tail_calls(tmp_path):
+    plain, tail = check_optimizations(tmp_path, TAIL_CALLS)
+    assert tail.cycles < plain.cycles
+    # The ten recursive calls of Main.count reuse a single frame
+    assert stack_top(tail) < stack_top(plain) - 50
+
+
+def test_intrinsics(tmp_path):
+    plain, intrinsic = check_optimizations(tmp_path, INTRINSICS)
+    assert intrinsic.cycles < plain.cycles
+    # By constants, written inline without calling Math
+    asm = translate(tmp_path, optimizations=(INTRINSICS,))
+    assert '@Math.multiply\n' not in asm and '@Math.divide\n' not in asm
+
+
+def test_intrinsics_negative_operands(tmp_path):
+    write_program(tmp_path)
+    code = "function Sys.init 0\n"
+    cases = [(-7, 6), (7, -6), (-300, -100), (-1000, 7), (1000, -7),
+             (-1000, -7), (32767, 1)]
+    for i, (x, y) in enumerate(cases):
+        for function in ('multiply', 'divide'):
+            code += ''.join("push constant %d\n%s" % (abs(value), "neg\n"
+                                                      if value < 0 else "")
+                            for value in (x, y))
+            code += "call Math.%s 2\npop static %d\n" % (
+                function, 2 * i + (function == 'divide'))
+    code += "label HALT\ngoto HALT\n"
+    write_program(tmp_path, {'Sys': code})
+    asm = translate(tmp_path, optimizations=(INTRINSICS,))
+    assert '($$MULTIPLY)' in asm and '($$DIVIDE)' in asm
+    emulator = emulate(tmp_path, optimizations=(INTRINSICS,))
+    assert [emulator.value(emulator.symbols['Sys.%d' % i])
+            for i in range(2 * len(cases))] == \
+        [-42, -1, -42, -1, 30000, 3, -7000, -142, -7000, -142, 7000, 142,
+         32767, 32767]
+
+
+def test_control_flow(tmp_path):
+    check_optimizations(tmp_path, CONTROL_FLOW)
+    # The code after goto LOOP is unreachable
+    assert '@999\n' in translate(tmp_path)
+    assert '@999\n' not in translate(tmp_path, optimizations=(CONTROL_FLOW,))
+
+
+def test_addressing(tmp_path):
+    plain, cheapest = check_optimizations(tmp_path, ADDRESSING)
+    assert cheapest.cycles < plain.cycles
+    assert rom_size(tmp_path, ADDRESSING) < rom_size(tmp_path)
+
+
+def test_addressing_with_cached_top_of_stack(tmp_path):
+    check_optimizations(tmp_path, ADDRESSING, TOS_CACHE)
+
+
+def test_base_reuse(tmp_path):
+    plain, reused = check_optimizations(tmp_path, BASE_REUSE)
+    assert reused.cycles < plain.cycles
+    assert rom_size(tmp_path, BASE_REUSE) < rom_size(tmp_path)
+
+
+def test_base_reuse_with_cached_top_of_stack(tmp_path):
+    check_optimizations(tmp_path, BASE_REUSE, TOS_CACHE)
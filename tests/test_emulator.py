@@ -0,0 +1,56 @@
+"""
+Tests of the Hack emulator, run with pytest from the repository root
+"""
+
+from programs import EXPECTED, emulate, results, write_program
+
+from Emulator import Emulator
+
+# RAM[2] = RAM[0] + RAM[1], skipping the dead store to RAM[3]
+ADD = """
+@R0
+D=M
+@R1
+D=D+M
+@STORE
+0;JMP
+@R3
+M=1
+(STORE)
+@R2
+M=D
+(END)
+@END
+0;JMP
+"""
+
+
+def test_runs_until_the_end_loop():
+    # The end loop is run once before it is found to loop forever
+    emulator = Emulator.from_asm(ADD.splitlines())
+    emulator.ram[0] = 2
+    emulator.ram[1] = 40
+    emulator.run()
+    assert emulator.halted
+    assert emulator.value(2) == 42
+    assert emulator.value(3) == 0
+    assert emulator.cycles == 10
+
+
+def test_executed_addresses():
+    emulator = Emulator.from_asm(ADD.splitlines())
+    emulator.run()
+    assert emulator.executed_addresses() == {0, 1, 2, 3, 4, 5, 8, 9, 10, 11}
+
+
+def test_stops_after_max_cycles():
+    emulator = Emulator.from_asm(ADD.splitlines())
+    assert emulator.run(3) == 3
+    assert not emulator.halted
+    emulator.run()
+    assert emulator.halted and emulator.cycles == 10
+
+
+def test_translated_program(tmp_path):
+    write_program(tmp_path)
+    assert results(emulate(tmp_path)) == EXPECTED
@@ -0,0 +1,43 @@
+"""
+Tests of the vm interpreter, run with pytest from the repository root
+"""
+
+from programs import EXPECTED, PROGRAM, emulate, results, write_program
+
+from Interpreter import Interpreter
+
+
+def interpret(directory):
+    interpreter = Interpreter.from_paths(sorted(
+        str(path) for path in directory.glob('*.vm')))
+    interpreter.run()
+    return interpreter
+
+
+def test_same_results_as_the_translation(tmp_path):
+    write_program(tmp_path)
+    assert results(interpret(tmp_path)) == EXPECTED
+    assert results(emulate(tmp_path)) == EXPECTED
+
+
+def test_comparisons_wrap_as_the_translation(tmp_path):
+    # The 16 bit differences of these comparisons overflow
+    pairs = [(32767, -2), (-32767, 2), (-2, 32767), (30000, -30000)]
+    code = "function Sys.init 0\n"
+    for i, (x, y) in enumerate(pairs):
+        for op in ('gt', 'lt'):
+            code += ''.join("push constant %d\n%s" % (abs(value), "neg\n"
+                                                      if value < 0 else "")
+                            for value in (x, y))
+            code += "%s\npop static %d\n" % (op, 2 * i + (op == 'lt'))
+    code += "label HALT\ngoto HALT\n"
+    # A second file, so that both start by calling Sys.init
+    write_program(tmp_path, {'Sys': code, 'Math': PROGRAM['Math']})
+
+    interpreter = interpret(tmp_path)
+    emulator = emulate(tmp_path)
+    statics = ['Sys.%d' % i for i in range(2 * len(pairs))]
+    assert [interpreter.value(interpreter.symbols[name])
+            for name in statics] == \
+        [emulator.value(emulator.symbols[name]) for name in statics]
+    assert interpreter.value(interpreter.symbols['Sys.0']) == 0
@@ -0,0 +1,52 @@
+"""
+Tests of the ways Main translates a directory, run with pytest from the
+repository root. They must all write the same output as translating the
+files one by one.
+"""
+
+from programs import translate, write_program
+
+from CodeWriter import GOALS, WHOLE_PROGRAM, SHARED_COMPARE, TOS_CACHE
+
+
+def test_parallel_same_as_sequential(tmp_path):
+    write_program(tmp_path)
+    sequential = translate(tmp_path)
+    assert translate(tmp_path, jobs=2) == sequential
+    assert translate(tmp_path, jobs=None) == sequential
+
+
+def test_parallel_same_as_sequential_optimized(tmp_path):
+    write_program(tmp_path)
+    # Fragments then also carry the shared routines they call. Whole
+    # program optimizations are translated in a single process.
+    optimizations = tuple(name for name in GOALS['size']
+                          if name not in WHOLE_PROGRAM)
+    sequential = translate(tmp_path, optimizations=optimizations)
+    assert translate(tmp_path, jobs=2,
+                     optimizations=optimizations) == sequential
+
+
+def test_cache_same_as_sequential(tmp_path):
+    program = write_program(tmp_path / 'Program')
+    cache = str(tmp_path / 'cache')
+    sequential = translate(program)
+    assert translate(program, cache_dir=cache) == sequential
+    assert translate(program, cache_dir=cache) == sequential  # from cache
+
+    # Only the changed file is translated again
+    main = program / 'Main.vm'
+    main.write_text(main.read_text().replace('push constant 123',
+                                             'push constant 124'))
+    sequential = translate(program)
+    assert translate(program, cache_dir=cache) == sequential
+
+
+def test_cache_keeps_optimizations_apart(tmp_path):
+    program = write_program(tmp_path / 'Program')
+    cache = str(tmp_path / 'cache')
+    optimizations = (SHARED_COMPARE, TOS_CACHE)
+    translate(program, cache_dir=cache)
+    assert translate(program, cache_dir=cache,
+                     optimizations=optimizations) == \
+        translate(program, optimizations=optimizations)
@@ -0,0 +1,129 @@
+"""
+Tests of the vm optimizer passes, run with pytest from the repository root
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Parser import *
+from Optimizer import fold_constants, push_constant, inline_functions, \
+    inline_body, eliminate_dead_functions
+
+NOT = (OP_NOT, 0, 0)
+ADD = (OP_ADD, 0, 0)
+
+
+def fold(*commands):
+    return list(fold_constants(commands))
+
+
+def test_folds_binary_operations():
+    assert fold(push_constant(2), push_constant(3), ADD) == [push_constant(5)]
+
+
+def test_comparisons_wrap_as_the_hack_code():
+    # 32767 - (-2) overflows to a negative difference
+    assert fold(push_constant(32767), push_constant(2), (OP_NEG, 0, 0),
+                (OP_GT, 0, 0)) == [push_constant(0)]
+    assert fold(push_constant(32767), push_constant(2), (OP_NEG, 0, 0),
+                (OP_LT, 0, 0)) == [push_constant(-1)]
+    assert fold(push_constant(3), push_constant(2), (OP_GT, 0, 0)) == \
+        [push_constant(-1)]
+
+
+def test_folds_chains():
+    assert fold(push_constant(2), push_constant(3), ADD, NOT,
+                push_constant(1), ADD) == [push_constant(-5)]
+
+
+def test_not_of_largest_constant_is_kept():
+    # not 32767 is -32768, which can't be pushed as a constant
+    assert fold(push_constant(32767), NOT) == [push_constant(32767), NOT]
+
+
+def test_unfolded_unary_then_constant():
+    assert fold(push_constant(32767), NOT, push_constant(1), ADD) == \
+        [push_constant(32767), NOT, push_constant(1), ADD]
+
+
+def test_unfolded_unary_then_binary():
+    assert fold(push_constant(32767), NOT, ADD) == \
+        [push_constant(32767), NOT, ADD]
+
+
+def test_unfolded_unary_after_constants():
+    assert fold(push_constant(5), push_constant(32767), NOT, ADD) == \
+        [push_constant(5), push_constant(32767), NOT, ADD]
+
+
+def test_double_unary_cancels():
+    push_local = (OP_PUSH, SEGMENTS.index('local'), 0)
+    assert fold(push_local, NOT, NOT) == [push_local]
+
+
+def test_identity_dropped():
+    push_local = (OP_PUSH, SEGMENTS.index('local'), 0)
+    assert fold(push_local, push_constant(0), ADD) == [push_local]
+
+
+def test_if_goto_on_constant():
+    assert fold(push_constant(0), (OP_IF, 7, 0)) == []
+    assert fold(push_constant(-1), (OP_IF, 7, 0)) == [(OP_GOTO, 7, 0)]
+
+
+SYS = """
+function Sys.init 0
+push constant 3
+call Sys.double 1
+pop static 0
+label HALT
+goto HALT
+function Sys.double 0
+push argument 0
+push argument 0
+add
+return
+function Sys.unused 0
+push constant 0
+return
+"""
+
+
+def function_names(programs):
+    return [program.names[arg1] for program in programs
+            for op, arg1, arg2 in program.commands() if op == OP_FUNCTION]
+
+
+def test_inline_reports_fully_inlined_callees():
+    programs, inlined, callees = inline_functions([Parser.parse(
+        SYS.splitlines())])
+    assert inlined == 1
+    assert callees == {'Sys.double'}
+    assert 'Sys.unused' in function_names(programs)
+
+
+def test_callee_called_elsewhere_not_reported():
+    vm = SYS + "function Sys.other 0\ncall Sys.double 0\nreturn\n"
+    # The call without arguments is kept, Sys.double reads argument 0
+    programs, inlined, callees = inline_functions([Parser.parse(
+        vm.splitlines())])
+    assert inlined == 1
+    assert callees == set()
+
+
+def test_dead_functions():
+    programs, removed = eliminate_dead_functions([Parser.parse(
+        SYS.splitlines())])
+    assert removed == ['Sys.unused']
+    assert function_names(programs) == ['Sys.init', 'Sys.double']
+
+
+def test_inline_body_rejects_calls():
+    body = [(OP_CALL, 'Sys.other', 0), (OP_RETURN, None, 0)]
+    try:
+        inline_body('Sys.f', 0, 0, body, 0, 0, NameTable().intern)
+    except ValueError:
+        return
+    assert False, "expected ValueError"
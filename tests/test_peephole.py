@@ -0,0 +1,46 @@
+"""
+Tests of the peephole optimizer, run with pytest from the repository root
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Peephole import Peephole, RULES
+
+PUSH_POP = ('@5\nD=A\n@SP\nA=M\nM=D\n@SP\nM=M+1\n@SP\nAM=M-1\nD=M\n'
+            '@R13\nM=D\n')
+
+
+def optimize_in_chunks(peephole, asm, size):
+    lines = asm.splitlines(True)
+    out = ''
+    for start in range(0, len(lines), size):
+        out += peephole.optimize(''.join(lines[start:start + size]), False)
+    return out + peephole.optimize('', True)
+
+
+def test_push_pop_removed():
+    assert Peephole(['push-pop']).optimize(PUSH_POP) == '@5\nD=A\n@R13\nM=D\n'
+
+
+def test_matches_split_between_chunks():
+    # However the code is split, every match is found
+    expected = Peephole(['push-pop']).optimize(PUSH_POP * 3)
+    for size in range(1, 13):
+        assert optimize_in_chunks(Peephole(['push-pop']), PUSH_POP * 3,
+                                  size) == expected
+
+
+def test_unknown_rule():
+    try:
+        Peephole(['no-such-rule'])
+    except ValueError:
+        return
+    assert False, "expected ValueError"
+
+
+def test_every_rule_selectable():
+    for name in RULES:
+        assert list(Peephole([name]).counts) == [name]
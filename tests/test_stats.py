@@ -0,0 +1,39 @@
+"""
+Tests of the translation statistics, run with pytest from the repository
+root
+"""
+
+from programs import translate, write_program
+
+from CodeWriter import CONSTANT_FOLDING, SUPERINSTRUCTIONS
+from Stats import Stats
+
+
+def gather(directory, *optimizations):
+    stats = Stats()
+    translate(directory, stats=stats, optimizations=optimizations)
+    return stats
+
+
+def counts(entries):
+    return {name: entry['count'] for name, entry in entries.items()}
+
+
+def test_counts_every_parsed_command(tmp_path):
+    write_program(tmp_path)
+    plain = gather(tmp_path)
+    optimized = gather(tmp_path, CONSTANT_FOLDING, SUPERINSTRUCTIONS)
+    assert counts(optimized.commands) == counts(plain.commands)
+    assert counts(optimized.arithmetic) == counts(plain.arithmetic)
+    assert plain.commands['C_PUSH']['count'] == 67
+
+
+def test_superinstructions_credited_to_their_commands(tmp_path):
+    write_program(tmp_path, {'Main': "function Main.main 2\n"
+                                     "push local 0\npop local 1\n"
+                                     "push constant 0\nreturn\n"})
+    stats = gather(tmp_path, SUPERINSTRUCTIONS)
+    copy = stats.methods['writeFused']['instructions']
+    assert copy > 0
+    assert stats.commands['C_PUSH']['instructions'] + \
+        stats.commands['C_POP']['instructions'] >= copy